@@ -15,12 +15,11 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     # Fetch deals with basic info
     deals = fetch_deals(start_date=start_date, end_date=end_date)
 
-    # Attach owner details
-    deals = fetch_and_attach_owner_details(deals, "hubspot_owner_id")
-    deals = fetch_and_attach_owner_details(deals, "team_member_1")
+    # Attach lead owner and support member details in one directory pass
+    deals = fetch_and_attach_owner_details(deals)
 
     # Fetch notes, attachments, and engagements asynchronously
-    deals = asyncio.run(fetch_notes_attachments_and_engagements(deals))
+    deals = attach_notes_attachments_and_engagements(deals)
 
     json_response = json.dumps(deals)
     return func.HttpResponse(
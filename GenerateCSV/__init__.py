@@ -11,9 +11,11 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     # Get date parameters (defaults to last 3 months if not provided)
     start_date = req.params.get("start_date", None)
     end_date = req.params.get("end_date", None)
+    # "properties" (default) or "history" for stages that deals re-enter
+    stage_source = req.params.get("stage_source", "properties")
 
     # Generate the CSV in-memory
-    csv_output, filename = export_csv(start_date, end_date)
+    csv_output, filename = export_csv(start_date, end_date, stage_source=stage_source)
 
     # Return the CSV as an HTTP response with the appropriate headers
     return func.HttpResponse(
@@ -0,0 +1,571 @@
+"""
+Attachment text extraction.
+
+Parsing PDFs, Word documents, spreadsheets and decks is CPU-bound, so it
+runs in a bounded process pool rather than on the HubSpot client's event
+loop. This module has no import-time side effects so pool workers can
+import it cheaply.
+
+Extractors are registered per extension/MIME type with
+``register_extractor``. ``python -m attachments bench <dir>`` compares
+them on a local corpus.
+"""
+
+import argparse
+import asyncio
+import atexit
+import csv
+import email.policy
+import hashlib
+import io
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing, contextmanager
+from email.parser import BytesParser
+from io import BytesIO
+
+import PyPDF2
+import docx
+import openpyxl
+from pptx import Presentation
+
+from prompt_serializer import CHARS_PER_TOKEN, DEAL_PROMPT_ITEM_TOKENS
+
+try:
+    import fitz  # PyMuPDF, an optional faster PDF engine
+except ImportError:
+    fitz = None
+
+
+# Downloads larger than ATTACHMENT_MAX_BYTES are rejected; past
+# ATTACHMENT_SPOOL_BYTES they are spilled to a temp file and memory-mapped
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(100 * 1024 * 1024)))
+ATTACHMENT_SPOOL_BYTES = int(os.getenv("ATTACHMENT_SPOOL_BYTES", str(8 * 1024 * 1024)))
+
+# Per-document extraction budget and rows kept per spreadsheet sheet;
+# parsing stops once the budget is spent. The prompt keeps at most
+# DEAL_PROMPT_ITEM_TOKENS of an attachment, so extract that much text plus
+# half again for the whitespace and repeats clean_text collapses
+ATTACHMENT_CHAR_BUDGET = int(
+    os.getenv(
+        "ATTACHMENT_CHAR_BUDGET",
+        str(DEAL_PROMPT_ITEM_TOKENS * CHARS_PER_TOKEN * 3 // 2),
+    )
+)
+ATTACHMENT_SHEET_ROWS = int(os.getenv("ATTACHMENT_SHEET_ROWS", "50"))
+TRUNCATED_MARKER = "[truncated]"
+
+# Pool size and per-document timeout; override with ATTACHMENT_WORKERS and
+# ATTACHMENT_TIMEOUT_SECONDS
+ATTACHMENT_WORKERS = int(os.getenv("ATTACHMENT_WORKERS", "0")) or os.cpu_count() or 1
+ATTACHMENT_TIMEOUT_SECONDS = float(os.getenv("ATTACHMENT_TIMEOUT_SECONDS", "60"))
+
+
+# Bumped whenever extractor output changes, so cached extractions from an
+# older version are not reused
+EXTRACTION_VERSION = 2
+
+
+class MmapReader(io.RawIOBase):
+    """Read-only, seekable raw stream over an mmap."""
+
+    def __init__(self, mapped):
+        self._mapped = mapped
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        chunk = self._mapped[self._position : self._position + len(buffer)]
+        buffer[: len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._mapped)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+@contextmanager
+def open_source(source):
+    """A binary stream over document bytes or, for spilled downloads, a file path."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield BytesIO(source)
+        return
+    with open(source, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            yield BytesIO()
+            return
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with io.BufferedReader(MmapReader(mapped)) as stream:
+                yield stream
+
+
+def _as_stream(file_content):
+    return BytesIO(file_content) if isinstance(file_content, (bytes, bytearray)) else file_content
+
+
+def take_text(pieces, budget=ATTACHMENT_CHAR_BUDGET, separator="\n"):
+    """
+    Join text pieces from a lazy extractor until ``budget`` characters.
+
+    The generator is closed as soon as the budget is reached, so the rest
+    of the document is never parsed.
+    """
+    parts = []
+    used = 0
+    with closing(pieces):
+        for piece in pieces:
+            if not piece:
+                continue
+            if budget and used + len(piece) > budget:
+                parts.append(piece[: max(budget - used, 0)])
+                parts.append(TRUNCATED_MARKER)
+                break
+            parts.append(piece)
+            used += len(piece) + len(separator)
+    return separator.join(parts)
+
+
+# Registry of lazy extractors: extension -> {engine name: iterator}. The
+# first engine registered for an extension is its default; pick another
+# with ATTACHMENT_ENGINES, e.g. "pdf=pymupdf,xlsx=openpyxl".
+EXTRACTORS = {}
+MIME_TYPES = {}
+ENGINE_OVERRIDES = dict(
+    item.split("=", 1)
+    for item in os.getenv("ATTACHMENT_ENGINES", "").split(",")
+    if "=" in item
+)
+
+
+def register_extractor(*extensions, engine, mime_types=()):
+    """
+    Register a generator ``func(stream)`` that yields a document's text in
+    pieces (pages, slides, rows, ...) for the given extensions.
+    """
+
+    def decorator(func):
+        for extension in extensions:
+            EXTRACTORS.setdefault(extension, {})[engine] = func
+        for mime_type in mime_types:
+            MIME_TYPES.setdefault(mime_type, extensions[0])
+        return func
+
+    return decorator
+
+
+def resolve_extension(extension=None, mime_type=None):
+    extension = (extension or "").lower().lstrip(".")
+    if extension in EXTRACTORS:
+        return extension
+    mime_type = (mime_type or "").split(";")[0].strip().lower()
+    return MIME_TYPES.get(mime_type, extension)
+
+
+def get_extractor(extension=None, mime_type=None, engine=None):
+    engines = EXTRACTORS.get(resolve_extension(extension, mime_type))
+    if not engines:
+        return None
+    engine = engine or ENGINE_OVERRIDES.get(resolve_extension(extension, mime_type))
+    return engines.get(engine) or next(iter(engines.values()))
+
+
+def is_supported(extension, mime_type=None):
+    return get_extractor(extension, mime_type) is not None
+
+
+def sample_rows(rows, max_rows=ATTACHMENT_SHEET_ROWS, total_rows=None):
+    """Header plus the first ``max_rows`` non-empty rows, tab-separated."""
+    shown = 0
+    for row in rows:
+        if shown > max_rows:
+            if total_rows:
+                yield f"... {total_rows - shown} more rows"
+            break
+        if any(value not in (None, "") for value in row):
+            yield "\t".join("" if value is None else str(value) for value in row)
+            shown += 1
+
+
+def _text_stream(stream):
+    return io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline="")
+
+
+@register_extractor("pdf", engine="pypdf2", mime_types=("application/pdf",))
+def iter_pdf(stream):
+    for page in PyPDF2.PdfReader(stream).pages:
+        yield page.extract_text()
+
+
+@register_extractor(
+    "docx",
+    engine="python-docx",
+    mime_types=("application/vnd.openxmlformats-officedocument.wordprocessingml.document",),
+)
+def iter_word(stream):
+    for paragraph in docx.Document(stream).paragraphs:
+        yield paragraph.text
+
+
+@register_extractor(
+    "xlsx",
+    engine="openpyxl",
+    mime_types=("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",),
+)
+def iter_excel(stream, max_rows=ATTACHMENT_SHEET_ROWS):
+    """Each sheet's header and first ``max_rows`` rows, tab-separated."""
+    workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield f"Sheet: {sheet.title}"
+            yield from sample_rows(sheet.iter_rows(values_only=True), max_rows, sheet.max_row)
+    finally:
+        workbook.close()
+
+
+@register_extractor(
+    "pptx",
+    engine="python-pptx",
+    mime_types=("application/vnd.openxmlformats-officedocument.presentationml.presentation",),
+)
+def iter_ppt(stream):
+    for slide in Presentation(stream).slides:
+        yield "\n".join(
+            shape.text for shape in slide.shapes if getattr(shape, "text", "")
+        )
+
+
+@register_extractor("txt", "md", engine="text", mime_types=("text/plain", "text/markdown"))
+def iter_text(stream):
+    for line in _text_stream(stream):
+        yield line.rstrip("\r\n")
+
+
+@register_extractor("csv", engine="csv", mime_types=("text/csv",))
+def iter_csv(stream, max_rows=ATTACHMENT_SHEET_ROWS):
+    yield from sample_rows(csv.reader(_text_stream(stream)), max_rows)
+
+
+@register_extractor("eml", engine="email", mime_types=("message/rfc822",))
+def iter_eml(stream):
+    message = BytesParser(policy=email.policy.default).parse(stream)
+    for header in ("From", "To", "Cc", "Date", "Subject"):
+        if message[header]:
+            yield f"{header}: {message[header]}"
+    body = message.get_body(preferencelist=("plain", "html"))
+    if body is not None:
+        content = body.get_content()
+        if body.get_content_type() == "text/html":
+            content = re.sub(r"<[^>]+>", " ", content)
+        yield content
+    for part in message.iter_attachments():
+        yield f"Attachment: {part.get_filename()}"
+
+
+ANTIWORD = shutil.which("antiword")
+if ANTIWORD:
+
+    @register_extractor("doc", engine="antiword", mime_types=("application/msword",))
+    def iter_doc(stream):
+        # antiword only reads files, so the stream is copied to one first
+        with tempfile.NamedTemporaryFile(suffix=".doc") as handle:
+            shutil.copyfileobj(stream, handle)
+            handle.flush()
+            result = subprocess.run(
+                [ANTIWORD, handle.name],
+                capture_output=True,
+                check=True,
+                timeout=ATTACHMENT_TIMEOUT_SECONDS,
+            )
+        yield from result.stdout.decode("utf-8", errors="replace").splitlines()
+
+
+if fitz is not None:
+
+    @register_extractor("pdf", engine="pymupdf")
+    def iter_pdf_pymupdf(stream):
+        with fitz.open(stream=stream.read(), filetype="pdf") as document:
+            for page in document:
+                yield page.get_text()
+
+
+def read_pdf(file_content, budget=ATTACHMENT_CHAR_BUDGET):
+    return take_text(iter_pdf(_as_stream(file_content)), budget)
+
+
+def read_word(file_content, budget=ATTACHMENT_CHAR_BUDGET):
+    return take_text(iter_word(_as_stream(file_content)), budget)
+
+
+def read_excel(file_content, budget=ATTACHMENT_CHAR_BUDGET):
+    return take_text(iter_excel(_as_stream(file_content)), budget)
+
+
+def read_ppt(file_content, budget=ATTACHMENT_CHAR_BUDGET):
+    return take_text(iter_ppt(_as_stream(file_content)), budget)
+
+
+def extract(extension, source, mime_type=None, engine=None, budget=ATTACHMENT_CHAR_BUDGET):
+    """Extract budgeted text from document bytes or a file path."""
+    extractor = get_extractor(extension, mime_type, engine)
+    if extractor is None:
+        raise ValueError(f"Unsupported file type: {extension or mime_type}")
+    with open_source(source) as stream:
+        return take_text(extractor(stream), budget)
+
+
+def check_size(size, name=None, max_bytes=ATTACHMENT_MAX_BYTES):
+    if max_bytes and size is not None and int(size) > max_bytes:
+        raise ValueError(
+            f"Attachment {name} is {int(size)} bytes, over the {max_bytes} byte limit"
+        )
+
+
+class SpooledDownload:
+    """
+    Download buffer that spills to disk.
+
+    Chunks are hashed as they arrive and kept in memory until
+    ``spool_bytes``, then moved to a temp file. ``source()`` hands the
+    extraction pool either the bytes or the file path, so a large document
+    never needs a second in-memory copy.
+    """
+
+    def __init__(self, name=None, max_bytes=ATTACHMENT_MAX_BYTES, spool_bytes=ATTACHMENT_SPOOL_BYTES):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self._buffer = BytesIO()
+        self._file = None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        check_size(self.size, self.name, self.max_bytes)
+        self.sha256.update(chunk)
+        if self._file is None and self.size > self.spool_bytes:
+            self._file = tempfile.NamedTemporaryFile(prefix="attachment-", delete=False)
+            self._file.write(self._buffer.getbuffer())
+            self._buffer = None
+        (self._file or self._buffer).write(chunk)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def source(self):
+        if self._file is None:
+            return self._buffer.getvalue()
+        self._file.close()
+        return self._file.name
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.unlink(self._file.name)
+            except FileNotFoundError:
+                pass
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ExtractionPool:
+    """
+    Bounded process pool for document extraction.
+
+    At most ``max_workers`` documents are parsed at once; further callers
+    wait on a semaphore so pending downloads don't pile up in the pool's
+    queue. A document that exceeds ``timeout`` seconds fails on its own, and
+    the pool is recycled because a hung worker cannot be cancelled.
+    """
+
+    def __init__(self, max_workers=ATTACHMENT_WORKERS, timeout=ATTACHMENT_TIMEOUT_SECONDS):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawned workers don't inherit the parent's event-loop thread
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.Semaphore(self.max_workers)
+            return self._semaphores[loop]
+
+    def _recycle(self, executor):
+        """Replace the pool, killing workers that may be stuck on a document."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        # Terminating the workers breaks the old pool, failing everything
+        # still queued on it with BrokenProcessPool
+        executor.shutdown(wait=False)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    async def extract(self, extension, source, name=None, mime_type=None):
+        if not is_supported(extension, mime_type):
+            raise ValueError(f"Unsupported file type: {extension or mime_type} for {name}")
+        async with self._semaphore():
+            for attempt in range(2):
+                executor = self._get_executor()
+                future = asyncio.get_running_loop().run_in_executor(
+                    executor, extract, extension, source, mime_type
+                )
+                try:
+                    return await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    logging.warning(
+                        f"Extraction of {name} timed out after {self.timeout}s; recycling pool"
+                    )
+                    self._recycle(executor)
+                    raise TimeoutError(f"Extraction timed out for {name}")
+                except BrokenProcessPool:
+                    # Caught in another document's recycle (or a crashed
+                    # worker): give it one more go on a fresh pool
+                    if attempt:
+                        raise
+                    self._recycle(executor)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+extraction_pool = ExtractionPool()
+atexit.register(extraction_pool.close)
+
+
+def _bench_engine(extension, engine, paths, budget=0):
+    """Run one extractor over ``paths`` and report totals; meant for a fresh child process."""
+    import resource
+
+    extractor = EXTRACTORS[extension][engine]
+    totals = {"files": 0, "bytes": 0, "pieces": 0, "chars": 0, "errors": 0}
+    started = time.perf_counter()
+    for path in paths:
+        totals["files"] += 1
+        totals["bytes"] += os.path.getsize(path)
+        chars = 0
+        try:
+            with open_source(path) as stream, closing(extractor(stream)) as pieces:
+                for piece in pieces:
+                    totals["pieces"] += 1
+                    chars += len(piece or "")
+                    if budget and chars >= budget:
+                        break
+        except Exception as error:
+            totals["errors"] += 1
+            logging.warning(f"{engine} failed on {path}: {error}")
+        totals["chars"] += chars
+    totals["seconds"] = time.perf_counter() - started
+    # ru_maxrss is in KiB on Linux
+    totals["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return totals
+
+
+def bench(corpus, budget=0):
+    """
+    Benchmark every registered extractor on the matching files under ``corpus``.
+
+    Each extractor runs in its own spawned process so peak RSS is its own.
+    """
+    paths_by_extension = {}
+    for root, _, files in os.walk(corpus):
+        for filename in files:
+            extension = resolve_extension(os.path.splitext(filename)[1])
+            if extension in EXTRACTORS:
+                paths_by_extension.setdefault(extension, []).append(
+                    os.path.join(root, filename)
+                )
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for extension, paths in sorted(paths_by_extension.items()):
+        for engine in EXTRACTORS[extension]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                totals = executor.submit(
+                    _bench_engine, extension, engine, paths, budget
+                ).result()
+            results.append({"extension": extension, "engine": engine, **totals})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m attachments")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_parser = commands.add_parser(
+        "bench", help="Benchmark registered extractors over a local corpus"
+    )
+    bench_parser.add_argument("corpus", help="Directory of sample documents")
+    bench_parser.add_argument(
+        "--budget",
+        type=int,
+        default=0,
+        help="Stop each document after this many characters (default: no limit)",
+    )
+    args = parser.parse_args(argv)
+
+    results = bench(args.corpus, args.budget)
+    if not results:
+        print("No documents with a registered extractor found")
+        return
+    # "pieces" are pages for PDFs, slides for decks and rows/lines/paragraphs otherwise
+    header = f"{'ext':<6}{'engine':<14}{'files':>7}{'MB':>9}{'MB/s':>9}{'pieces/s':>11}{'chars':>12}{'peak MB':>9}{'errors':>8}"
+    print(header)
+    for row in results:
+        megabytes = row["bytes"] / (1024 * 1024)
+        seconds = row["seconds"] or 1e-9
+        print(
+            f"{row['extension']:<6}{row['engine']:<14}{row['files']:>7}"
+            f"{megabytes:>9.1f}{megabytes / seconds:>9.2f}{row['pieces'] / seconds:>11.1f}"
+            f"{row['chars']:>12}{row['peak_rss_mb']:>9.1f}{row['errors']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
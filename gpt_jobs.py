@@ -0,0 +1,409 @@
+"""
+Resumable GPT batch jobs.
+
+A job moves through submitted -> polling -> downloaded -> written, and its
+state is checkpointed after every step. An invocation that runs out of
+time returns the job ID, and a later invocation resumes from the last
+checkpoint instead of throwing the submitted batches away.
+
+Batch requests carry the deal ID as ``custom_id``, so results join back
+to deals exactly. Output and error files are streamed line by line, and
+each batch's results are matched and written back as soon as it is
+downloaded; the checkpoint keeps parsed results per deal, never raw output.
+
+The enqueued-token limit is shared by every batch in flight for the
+organization, so shard input files are uploaded up front but batches are
+only created while the job's enqueued tokens stay under the limit. The
+rest wait in the checkpoint's queue until earlier batches finish.
+
+The runner only talks to the OpenAI client through ``batches.retrieve``
+and ``files.with_streaming_response.content``, and gets everything else
+(uploading, batch creation, writing, caching) as callables, so it can be
+driven by a fake client in tests.
+"""
+
+import json
+import logging
+import os
+import time
+import uuid
+
+SUBMITTED = "submitted"
+POLLING = "polling"
+DOWNLOADED = "downloaded"
+WRITTEN = "written"
+FAILED = "failed"
+TERMINAL_STATES = (WRITTEN, FAILED)
+
+# Default per-invocation time budget, kept under functionTimeout (10 min)
+GPT_JOB_TIME_BUDGET = float(os.getenv("GPT_JOB_TIME_BUDGET", "480"))
+GPT_JOB_TTL = 7 * 24 * 60 * 60
+POLL_MIN_SECONDS = 2.0
+POLL_MAX_SECONDS = 60.0
+MAX_RESUBMITS = 5
+# Wait before re-creating a token-limited shard when none of the job's own
+# batches are left to drain (the limit is taken up elsewhere in the org)
+RESUBMIT_BACKOFF_SECONDS = 60.0
+# Deals handed to ``write`` at once, between checkpoints
+WRITE_CHUNK_SIZE = 500
+
+# Batch statuses that will not change any more
+BATCH_DONE_STATUSES = ("completed", "expired", "cancelled", "failed")
+
+
+class GptJobFailed(RuntimeError):
+    """The job cannot finish, e.g. a batch failed; resuming won't help."""
+
+
+def next_poll_delay(batch, attempt, now=None):
+    """
+    Seconds until a batch is worth polling again.
+
+    Unstarted batches back off exponentially. Running ones are polled at a
+    fraction of their estimated remaining time, based on ``request_counts``.
+    Finalizing ones are polled at the minimum interval.
+    """
+    status = getattr(batch, "status", None)
+    if status == "finalizing":
+        return POLL_MIN_SECONDS
+    counts = getattr(batch, "request_counts", None)
+    total = getattr(counts, "total", 0) or 0
+    done = (getattr(counts, "completed", 0) or 0) + (getattr(counts, "failed", 0) or 0)
+    started_at = getattr(batch, "in_progress_at", None)
+    if status == "in_progress" and done and total and started_at:
+        elapsed = (now or time.time()) - started_at
+        remaining = elapsed / done * (total - done)
+        return min(max(remaining / 4, POLL_MIN_SECONDS), POLL_MAX_SECONDS)
+    return min(POLL_MIN_SECONDS * 2 ** attempt, POLL_MAX_SECONDS)
+
+
+def _token_limit_failure(batch):
+    errors = getattr(getattr(batch, "errors", None), "data", None) or []
+    return any(getattr(error, "code", None) == "token_limit_exceeded" for error in errors)
+
+
+def iter_file_lines(client, file_id):
+    """Stream a batch output/error file, parsing each JSONL line once."""
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def result_content(result):
+    """The completion text of a batch result line, or raise with the line's error."""
+    response = result.get("response") or {}
+    body = response.get("body") or {}
+    if result.get("error") or response.get("status_code", 200) != 200:
+        error = result.get("error") or body.get("error") or {}
+        raise ValueError(error.get("message") or f"status {response.get('status_code')}")
+    return body["choices"][0]["message"]["content"]
+
+
+class GptJobRunner:
+    """
+    Drives checkpointed GPT batch jobs.
+
+    ``upload(deals)`` uploads batch input files and returns them as
+    ``[{"input_file_id", "tokens"}]``, ``tokens`` being the shard's
+    estimated enqueued tokens. ``create_batch(input_file_id)`` creates a
+    batch from one. ``token_limit`` is the organization's enqueued-token
+    limit, or None for no throttling. ``write(deals)``
+    writes a list of ``{"id", "parsed", "properties"}`` deals back, where
+    ``properties`` are the values fetched when the job started, and returns
+    ``({deal_id: None or error}, [IDs skipped as unchanged])``.
+    ``on_match(entry, parsed)`` is called for every matched result, e.g. to
+    cache it. ``checkpoints`` needs ``get``/``set`` like storage.TTLCache.
+    """
+
+    def __init__(
+        self,
+        client,
+        checkpoints,
+        upload,
+        create_batch,
+        write,
+        on_match=None,
+        token_limit=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+        wall_clock=time.time,
+    ):
+        self.client = client
+        self.checkpoints = checkpoints
+        self.upload = upload
+        self.create_batch = create_batch
+        self.write = write
+        self.on_match = on_match
+        self.token_limit = token_limit
+        self.clock = clock
+        self.sleep = sleep
+        # Resubmit backoffs outlive the invocation, so they use wall time
+        self.wall_clock = wall_clock
+
+    # ------------------------------------------------------------ checkpoints
+
+    def load(self, job_id):
+        job = self.checkpoints.get(job_id)
+        if job is None:
+            raise ValueError(f"Unknown GPT job: {job_id}")
+        return job
+
+    def save(self, job):
+        job["updated_at"] = self.wall_clock()
+        self.checkpoints.set(job["id"], job, ttl=GPT_JOB_TTL)
+
+    # ------------------------------------------------------------- lifecycle
+
+    def start(self, deals, cache_keys=None, parsed=None, current=None):
+        """
+        Upload ``deals``, submit what fits under the token limit, and
+        checkpoint a new job. ``parsed`` holds results
+        already known (e.g. from the recommendation cache) by deal ID; those
+        deals skip the batch but are still written. ``current`` holds the
+        deals' fetched property values by deal ID.
+        """
+        cache_keys = cache_keys or {}
+        job = {
+            "id": str(uuid.uuid4()),
+            "state": SUBMITTED,
+            "deals": {
+                str(deal["id"]): {"cache_key": cache_keys.get(str(deal["id"]))}
+                for deal in deals
+            },
+            "batches": {},
+            "queued": [],
+            "errors": {},
+            "parsed": {str(deal_id): value for deal_id, value in (parsed or {}).items()},
+            "current": {str(deal_id): value for deal_id, value in (current or {}).items()},
+            "written": [],
+            "skipped": [],
+            "write_errors": {},
+            "error": None,
+            "created_at": self.wall_clock(),
+        }
+        if deals:
+            job["queued"] = [
+                {"input_file_id": shard["input_file_id"], "tokens": shard["tokens"]}
+                for shard in self.upload(deals)
+            ]
+            self.submit_queued(job)
+        self.save(job)
+        return job
+
+    def run(self, job_id, budget=GPT_JOB_TIME_BUDGET):
+        """Advance a job until it is written, has failed, or ``budget`` seconds pass."""
+        job = self.load(job_id)
+        deadline = self.clock() + budget
+        try:
+            while job["state"] not in TERMINAL_STATES:
+                if job["state"] in (SUBMITTED, POLLING):
+                    delay = self.poll(job)
+                    # Deals of batches that just finished are written right away
+                    if not self.write_back(job, deadline):
+                        break
+                    if delay is None:
+                        continue
+                    if self.clock() + delay > deadline:
+                        break
+                    self.sleep(delay)
+                elif job["state"] == DOWNLOADED:
+                    if not self.write_back(job, deadline):
+                        break
+                    job["state"] = WRITTEN
+        except GptJobFailed as error:
+            job["state"] = FAILED
+            job["error"] = str(error)
+            self.save(job)
+            raise
+        except Exception:
+            # Transient (network, API) errors leave the job resumable
+            self.save(job)
+            raise
+        self.save(job)
+        return job
+
+    # ----------------------------------------------------------------- steps
+
+    @staticmethod
+    def enqueued_tokens(job):
+        """Estimated tokens of the job's batches that haven't finished yet."""
+        return sum(
+            tracked.get("tokens", 0)
+            for tracked in job["batches"].values()
+            if not tracked["downloaded"]
+        )
+
+    def _may_submit(self, shard, enqueued):
+        if shard.get("retry_below") is not None:
+            # Token-limited earlier: wait for the job's own batches to drain
+            # below what was enqueued then, or for the backoff if there were none
+            if shard["retry_below"] > 0:
+                if enqueued >= shard["retry_below"]:
+                    return False
+            elif self.wall_clock() < shard.get("not_before", 0):
+                return False
+        # A shard always goes once nothing else of the job is enqueued
+        return not (
+            self.token_limit and enqueued and enqueued + shard["tokens"] > self.token_limit
+        )
+
+    def submit_queued(self, job):
+        """Create batches for queued shards, in order, while they fit under the limit."""
+        queued = job["queued"]
+        enqueued = self.enqueued_tokens(job)
+        while queued and self._may_submit(queued[0], enqueued):
+            shard = queued[0]
+            batch = self.create_batch(shard["input_file_id"])
+            queued.pop(0)
+            job["batches"][batch.id] = {
+                "status": getattr(batch, "status", None),
+                "attempt": 0,
+                "resubmits": shard.get("resubmits", 0),
+                "downloaded": False,
+                "tokens": shard["tokens"],
+                "input_file_id": shard["input_file_id"],
+            }
+            enqueued += shard["tokens"]
+            # Checkpoint each batch as soon as it exists so none is orphaned
+            self.save(job)
+
+    def poll(self, job):
+        """
+        Retrieve every outstanding batch once, downloading finished ones, and
+        submit queued shards that now fit. Returns the delay before the next
+        poll, or None once every shard is submitted and downloaded.
+        """
+        job["state"] = POLLING
+        delays = []
+        for batch_id, tracked in list(job["batches"].items()):
+            if tracked["downloaded"]:
+                continue
+            batch = self.client.batches.retrieve(batch_id)
+            tracked["status"] = batch.status
+            if batch.status == "failed" and _token_limit_failure(batch):
+                if tracked["resubmits"] >= MAX_RESUBMITS:
+                    raise GptJobFailed(f"Batch {batch_id} kept hitting the token limit")
+                del job["batches"][batch_id]
+                resubmits = tracked["resubmits"] + 1
+                # Back to the front of the queue, until capacity has been freed
+                job["queued"].insert(
+                    0,
+                    {
+                        "input_file_id": batch.input_file_id,
+                        "tokens": tracked.get("tokens", 0),
+                        "resubmits": resubmits,
+                        "retry_below": self.enqueued_tokens(job),
+                        "not_before": self.wall_clock()
+                        + RESUBMIT_BACKOFF_SECONDS * 2 ** (resubmits - 1),
+                    },
+                )
+                logging.info(f"Batch {batch_id} hit the token limit; queued to resubmit")
+            elif batch.status == "failed":
+                raise GptJobFailed(f"Batch processing failed. Error details: {batch}")
+            elif batch.status in BATCH_DONE_STATUSES:
+                self.download(job, batch, tracked)
+            else:
+                delays.append(next_poll_delay(batch, tracked["attempt"]))
+                tracked["attempt"] += 1
+        self.submit_queued(job)
+        in_flight = [
+            tracked for tracked in job["batches"].values() if not tracked["downloaded"]
+        ]
+        if not in_flight and not job["queued"]:
+            job["state"] = DOWNLOADED
+            self.save(job)
+            return None
+        if not in_flight:
+            # Only a backed-off shard is left; wake up when it may go
+            wait = job["queued"][0].get("not_before", 0) - self.wall_clock()
+            delays.append(min(max(wait, POLL_MIN_SECONDS), POLL_MAX_SECONDS))
+        self.save(job)
+        return min(delays) if delays else POLL_MIN_SECONDS
+
+    def download(self, job, batch, tracked):
+        """Match each line of a finished batch to its deal, keeping the parsed result or error."""
+        failed = 0
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for result in iter_file_lines(self.client, file_id):
+                custom_id = str(result.get("custom_id"))
+                try:
+                    content = result_content(result)
+                except (KeyError, IndexError, TypeError, ValueError) as error:
+                    job["errors"][custom_id] = str(error)
+                    failed += 1
+                    continue
+                try:
+                    parsed = json.loads(content)
+                except (TypeError, ValueError) as error:
+                    job["errors"][custom_id] = f"Unparseable result: {error}"
+                    failed += 1
+                    continue
+                self.match(job, custom_id, parsed)
+        if failed:
+            logging.warning(f"Batch {batch.id} returned {failed} failed requests")
+        tracked["errors"] = failed
+        tracked["downloaded"] = True
+        self.save(job)
+
+    def match(self, job, custom_id, parsed):
+        """Attach one parsed result to its deal by custom_id (the deal ID)."""
+        if custom_id not in job["deals"]:
+            logging.warning(f"GPT result for unknown custom_id {custom_id}")
+            job["errors"][custom_id] = "Unknown custom_id"
+            return
+        job["parsed"][custom_id] = parsed
+        if self.on_match:
+            self.on_match(job["deals"][custom_id], parsed)
+
+    def write_back(self, job, deadline):
+        """
+        Write matched deals that aren't written yet, in chunks, checkpointing
+        after each so a timeout loses little. Returns False if the deadline
+        cut it short.
+        """
+        done = set(job["written"]) | set(job["skipped"]) | set(job["write_errors"])
+        current = job["current"]
+        pending = [
+            {"id": deal_id, "parsed": parsed, "properties": current.get(deal_id, {})}
+            for deal_id, parsed in job["parsed"].items()
+            if deal_id not in done
+        ]
+        for start in range(0, len(pending), WRITE_CHUNK_SIZE):
+            if self.clock() > deadline:
+                return False
+            outcomes, skipped = self.write(pending[start : start + WRITE_CHUNK_SIZE])
+            skipped = set(skipped)
+            job["skipped"].extend(skipped)
+            for deal in pending[start : start + WRITE_CHUNK_SIZE]:
+                if deal["id"] in skipped:
+                    continue
+                error = outcomes.get(deal["id"])
+                if error:
+                    job["write_errors"][deal["id"]] = error
+                else:
+                    job["written"].append(deal["id"])
+            self.save(job)
+        return True
+
+
+def job_summary(job):
+    return {
+        "job_id": job["id"],
+        "state": job["state"],
+        "deals": len(job["deals"]),
+        "batches": {
+            batch_id: tracked["status"] for batch_id, tracked in job["batches"].items()
+        },
+        "queued": len(job["queued"]),
+        "matched": len(job["parsed"]),
+        "written": len(job["written"]),
+        "skipped": len(job["skipped"]),
+        "write_errors": job["write_errors"],
+        # Per-deal failures from the batch error file, unusable output or
+        # results whose custom_id is not one of the job's deals
+        "failed": job["errors"],
+        "error": job["error"],
+    }
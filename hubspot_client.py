@@ -0,0 +1,452 @@
+"""Shared, pooled HubSpot API client for sync and async callers."""
+
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import logging
+import random
+import ssl
+import threading
+import time
+from typing import Any, Awaitable, Optional
+
+import aiohttp
+import certifi
+import requests
+from requests.adapters import HTTPAdapter
+
+HUBSPOT_API_BASE = "https://api.hubapi.com"
+
+# Statuses the client retries on its own before handing the response back
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Longest a waiter sleeps before re-checking its bucket, so a raised rate
+# takes effect promptly for requests already waiting
+RATE_RECHECK_SECONDS = 1.0
+
+
+def _header_number(headers, name: str) -> Optional[float]:
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    ``try_take()`` takes tokens only when they are available and otherwise
+    says how long until they should be at the current rate, so waiters that
+    re-check pick up rate changes made while they slept. ``wait_time()`` and
+    ``take()`` split the two for callers drawing on several buckets at once.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _wait(self, amount: float) -> float:
+        # More than the bucket holds is granted once it is full, as debt
+        return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def try_take(self, amount: float = 1.0) -> float:
+        """Take ``amount`` and return 0.0, or take nothing and return the wait."""
+        with self._lock:
+            self._refill(time.monotonic())
+            wait = self._wait(amount)
+            if not wait:
+                self.tokens -= amount
+            return wait
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Seconds until ``amount`` can be taken at the current rate; takes nothing."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._wait(amount)
+
+    def take(self, amount: float = 1.0) -> None:
+        """Take ``amount`` now, e.g. once ``wait_time`` has returned 0."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+    def set_rate(self, rate: float, capacity: Optional[float] = None) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.capacity = capacity or max(1.0, rate)
+
+    def resize(self, rate: float, capacity: float) -> None:
+        """
+        Change rate and capacity for a limit found to differ from the one
+        assumed, shifting the available tokens by the change in capacity.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(capacity, self.tokens + capacity - self.capacity)
+            self.rate = rate
+            self.capacity = capacity
+
+    def pause(self, seconds: float) -> None:
+        """Hold back every waiter for at least ``seconds`` from now."""
+        with self._lock:
+            self._refill(time.monotonic())
+            # Concurrent 429s for the same window don't stack their pauses
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class RateGovernor:
+    """
+    Process-wide HubSpot rate and concurrency governor.
+
+    General API calls and CRM search calls draw from separate token buckets,
+    because HubSpot limits search per account and does not report it in
+    headers. The general bucket's ceiling is learned from the
+    ``X-HubSpot-RateLimit-*`` headers; the rate and the in-flight limit back
+    off multiplicatively on 429s and recover additively on success.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        search_rate: float = 4.0,
+        max_in_flight: int = 16,
+        min_rate: float = 0.5,
+        headroom: float = 0.9,
+    ):
+        self.bucket = TokenBucket(rate)
+        self.search_bucket = TokenBucket(search_rate)
+        self.target_rate = rate
+        self.search_target_rate = search_rate
+        self.min_rate = min_rate
+        self.headroom = headroom
+        self.max_in_flight = max_in_flight
+        self.limit = max_in_flight
+        self.in_flight = 0
+        self._waiters = []
+
+    @staticmethod
+    def is_search(url: str) -> bool:
+        return url.split("?", 1)[0].rstrip("/").endswith("/search")
+
+    def _bucket(self, url: str) -> TokenBucket:
+        return self.search_bucket if self.is_search(url) else self.bucket
+
+    def wait(self, url: str) -> None:
+        """Block until a rate token is taken. For sync callers."""
+        bucket = self._bucket(url)
+        while True:
+            delay = bucket.try_take()
+            if not delay:
+                return
+            time.sleep(min(delay, RATE_RECHECK_SECONDS))
+
+    async def acquire(self, url: str) -> None:
+        """
+        Wait for an in-flight slot, then for a rate token. Client loop only.
+
+        The token is only taken once the bucket has one at its current rate,
+        so 429 back-offs and learned limits also slow requests already waiting.
+        """
+        while self.in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self.in_flight += 1
+        bucket = self._bucket(url)
+        try:
+            while True:
+                delay = bucket.try_take()
+                if not delay:
+                    return
+                await asyncio.sleep(min(delay, RATE_RECHECK_SECONDS))
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self) -> None:
+        free = self.limit - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def observe(self, url: str, status: int, headers) -> None:
+        """Adapt rate and concurrency to a HubSpot response."""
+        search = self.is_search(url)
+        bucket = self.search_bucket if search else self.bucket
+
+        if status == 429:
+            retry_after = _header_number(headers, "Retry-After") or 1.0
+            bucket.set_rate(max(self.min_rate, bucket.rate / 2))
+            bucket.pause(retry_after)
+            self.limit = max(1, self.limit // 2)
+            logging.warning(
+                f"HubSpot rate limit hit; slowing to {bucket.rate:.1f} req/s, "
+                f"{self.limit} in flight"
+            )
+            return
+        if status >= 400:
+            return
+
+        if not search and self._learn_ceiling(headers):
+            return
+        target = self.search_target_rate if search else self.target_rate
+        if bucket.rate < target:
+            bucket.set_rate(min(target, bucket.rate + max(0.1, target * 0.05)))
+        elif bucket.rate > target:
+            bucket.set_rate(target)
+        if self.limit < self.max_in_flight:
+            self.limit += 1
+
+    def _learn_ceiling(self, headers) -> bool:
+        """Update the target rate from headers; return True if we had to ease off."""
+        limits = []
+        window_max = _header_number(headers, "X-HubSpot-RateLimit-Max")
+        interval_ms = _header_number(headers, "X-HubSpot-RateLimit-Interval-Milliseconds")
+        if window_max and interval_ms:
+            limits.append(window_max / (interval_ms / 1000))
+        secondly = _header_number(headers, "X-HubSpot-RateLimit-Secondly")
+        if secondly:
+            limits.append(secondly)
+        if limits:
+            self.target_rate = max(self.min_rate, min(limits) * self.headroom)
+
+        # Other clients on the same account share the window; ease off when it runs low
+        remaining = _header_number(headers, "X-HubSpot-RateLimit-Remaining")
+        if window_max and remaining is not None and remaining < window_max * 0.1:
+            self.bucket.set_rate(max(self.min_rate, self.bucket.rate * 0.75))
+            return True
+        return False
+
+    @staticmethod
+    def retry_delay(attempt: int, status: int, headers) -> float:
+        if status == 429:
+            # observe() already paused the bucket; acquire() does the waiting
+            return 0.0
+        retry_after = _header_number(headers, "Retry-After")
+        if retry_after is not None:
+            return retry_after
+        return min(30.0, 2**attempt) * random.uniform(0.5, 1.0)
+
+
+class HubSpotClient:
+    """
+    One HubSpot client per process.
+
+    The sync side is a ``requests.Session`` with a pooled adapter. The async
+    side is a single ``aiohttp.ClientSession`` that lives on a dedicated
+    background event loop, so keep-alive connections and TLS sessions survive
+    across ``run()`` calls and across warm Azure Functions invocations.
+
+    The bearer token is only attached to requests against the HubSpot API
+    host; the same sessions can be used for signed file URLs without leaking
+    credentials. API requests are paced by a shared ``RateGovernor`` and
+    retried on 429/5xx before the response is handed back.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = HUBSPOT_API_BASE,
+        pool_size: int = 32,
+        max_retries: int = 5,
+        governor: Optional[RateGovernor] = None,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.governor = governor or RateGovernor()
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._async_session: Optional[aiohttp.ClientSession] = None
+        atexit.register(self.close)
+
+    def url(self, path: str) -> str:
+        """Resolve an API path (``/crm/v3/...``) or pass a full URL through."""
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def _is_api(self, url: str) -> bool:
+        return url.startswith(self.base_url)
+
+    def _headers_for(self, url: str, extra: Optional[dict]) -> dict:
+        headers = dict(self.headers) if self._is_api(url) else {}
+        if extra:
+            headers.update(extra)
+        return headers
+
+    # ------------------------------------------------------------------ sync
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=4, pool_maxsize=self.pool_size
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def request(self, method: str, path: str, **kwargs: Any) -> requests.Response:
+        url = self.url(path)
+        headers = self._headers_for(url, kwargs.pop("headers", None))
+        if not self._is_api(url):
+            return self.session.request(method, url, headers=headers, **kwargs)
+
+        attempt = 0
+        while True:
+            self.governor.wait(url)
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            self.governor.observe(url, response.status_code, response.headers)
+            if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                return response
+            time.sleep(
+                self.governor.retry_delay(attempt, response.status_code, response.headers)
+            )
+            attempt += 1
+
+    def get(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
+    def patch(self, path: str, **kwargs: Any) -> requests.Response:
+        return self.request("PATCH", path, **kwargs)
+
+    # ----------------------------------------------------------------- async
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._thread is None or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._async_session = None
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="hubspot-client", daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def submit(self, coro: Awaitable) -> concurrent.futures.Future:
+        """Schedule a coroutine on the client's loop without waiting for it."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro: Awaitable) -> Any:
+        """
+        Run a coroutine on the client's persistent event loop and block for the result.
+
+        Use this instead of ``asyncio.run`` for anything that talks to HubSpot
+        asynchronously, so the pooled ``aiohttp`` session is reused.
+        """
+        loop = self._ensure_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            raise RuntimeError(
+                "HubSpotClient.run() cannot be called from the client's own loop; await the coroutine instead"
+            )
+        return self.submit(coro).result()
+
+    async def async_session(self) -> aiohttp.ClientSession:
+        """Return the shared ``aiohttp`` session. Must be awaited on the client loop."""
+        if asyncio.get_running_loop() is not self._loop:
+            raise RuntimeError(
+                "HubSpot async calls must run on the client loop; use hubspot.run(...)"
+            )
+        if self._async_session is None or self._async_session.closed:
+            connector = aiohttp.TCPConnector(
+                ssl=self.ssl_context,
+                limit=self.pool_size,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            )
+            self._async_session = aiohttp.ClientSession(connector=connector)
+        return self._async_session
+
+    @contextlib.asynccontextmanager
+    async def request_async(self, method: str, path: str, **kwargs: Any):
+        """Async counterpart of ``request``; yields the ``aiohttp`` response."""
+        session = await self.async_session()
+        url = self.url(path)
+        headers = self._headers_for(url, kwargs.pop("headers", None))
+        if not self._is_api(url):
+            async with session.request(method, url, headers=headers, **kwargs) as response:
+                yield response
+            return
+
+        attempt = 0
+        while True:
+            await self.governor.acquire(url)
+            try:
+                response = await session.request(method, url, headers=headers, **kwargs)
+            except BaseException:
+                self.governor.release()
+                raise
+            self.governor.observe(url, response.status, response.headers)
+            if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                response.release()
+                self.governor.release()
+                await asyncio.sleep(
+                    self.governor.retry_delay(attempt, response.status, response.headers)
+                )
+                attempt += 1
+                continue
+            try:
+                yield response
+            finally:
+                response.release()
+                self.governor.release()
+            return
+
+    # -------------------------------------------------------------- shutdown
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+            loop, session = self._loop, self._async_session
+            self._loop = self._thread = self._async_session = None
+        if loop is not None and loop.is_running():
+            if session is not None and not session.closed:
+                with contextlib.suppress(Exception):
+                    asyncio.run_coroutine_threadsafe(session.close(), loop).result(5)
+            loop.call_soon_threadsafe(loop.stop)
@@ -1,25 +1,37 @@
+import ast
+import hashlib
 import io
 import json
 import logging
 import os
-import ssl
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from io import BytesIO
-import aiohttp
 import asyncio
 
-import PyPDF2
-import certifi
-import docx
+import aiohttp
 import openai
 import pandas as pd
-import requests
-from dateutil import parser
 from dateutil.relativedelta import relativedelta
-from pptx import Presentation
 
-import uuid
+
+from attachments import (
+    EXTRACTION_VERSION,
+    SpooledDownload,
+    check_size,
+    extraction_pool,
+    is_supported,
+    read_excel,
+    read_pdf,
+    read_ppt,
+    read_word,
+)
+from gpt_jobs import GPT_JOB_TIME_BUDGET, WRITTEN, GptJobRunner, job_summary
+from hubspot_client import HubSpotClient
+from openai_realtime import OpenAIRateLimiter, complete, complete_all
+from prompt_serializer import count_tokens, serialize_deal
+from storage import DealStore, TTLCache
 
 
 def get_secrets():
@@ -61,193 +73,142 @@ if mode == "dev":
 ) = get_secrets()
 print("Env Setup")
 
+# One pooled HubSpot client per process, reused across warm invocations
+hubspot = HubSpotClient(HUBSPOT_API_KEY)
+
 
 def search_hubspot_object(object_type, search_body):
-    url = f"https://api.hubapi.com/crm/v3/objects/{object_type}/search"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-    }
-    response = requests.post(url, headers=headers, data=json.dumps(search_body))
+    response = hubspot.post(
+        f"/crm/v3/objects/{object_type}/search", data=json.dumps(search_body)
+    )
     response.raise_for_status()
     return response.json()
 
 
-# Cache for storing owner details
-owner_details_cache = {}
+# Owner directory: every HubSpot owner, indexed by id, cached on disk with a TTL
+owner_cache = TTLCache("owners")
+OWNER_DIRECTORY_TTL = 24 * 60 * 60
+# Minimum gap between directory refreshes triggered by unknown owner IDs
+OWNER_REFRESH_COOLDOWN = 60
+OWNER_PROPERTIES = ("hubspot_owner_id", "team_member_1")
 
+_owner_directory = None
+_owner_directory_fetched_at = 0.0
+_owner_directory_lock = threading.Lock()
 
-# Async function to fetch owner details with throttling and caching (v3 API)
-async def fetch_owner_details_async(session, owner_id):
-    if owner_id in owner_details_cache:
-        return owner_id, owner_details_cache[owner_id]
 
-    url = f"https://api.hubapi.com/crm/v3/owners/{owner_id}"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-    }
+def fetch_owner_directory():
+    """Page through /crm/v3/owners (active and archived) into an id -> owner index."""
+    owners = {}
+    for archived in ("false", "true"):
+        params = {"limit": 100, "archived": archived}
+        while True:
+            response = hubspot.get("/crm/v3/owners", params=params)
+            response.raise_for_status()
+            data = response.json()
+            for owner in data.get("results", []):
+                owners[str(owner["id"])] = owner
+            after = data.get("paging", {}).get("next", {}).get("after")
+            if not after:
+                break
+            params["after"] = after
+    return owners
+
+
+def load_owner_directory(force_refresh=False):
+    global _owner_directory, _owner_directory_fetched_at
+    with _owner_directory_lock:
+        if not force_refresh:
+            if (
+                _owner_directory is not None
+                and time.time() - _owner_directory_fetched_at < OWNER_DIRECTORY_TTL
+            ):
+                return _owner_directory
+            cached = owner_cache.get("directory")
+            if cached is not None:
+                _owner_directory = cached["owners"]
+                _owner_directory_fetched_at = cached["fetched_at"]
+                return _owner_directory
+
+        owners = fetch_owner_directory()
+        _owner_directory = owners
+        _owner_directory_fetched_at = time.time()
+        owner_cache.set(
+            "directory",
+            {"owners": owners, "fetched_at": _owner_directory_fetched_at},
+            ttl=OWNER_DIRECTORY_TTL,
+        )
+        logging.info(f"Loaded owner directory: {len(owners)} owners")
+        return owners
 
-    max_retries = 3
-    backoff_time = 2
 
-    for attempt in range(max_retries):
-        try:
-            async with session.get(url, headers=headers) as response:
-                if response.status == 200:
-                    owner_data = await response.json()
-                    owner_details_cache[owner_id] = owner_data
-                    return owner_id, owner_data
-                elif response.status == 429:  # Rate limit
-                    await asyncio.sleep(backoff_time)
-                    backoff_time *= 2
-                else:
-                    logging.error(
-                        f"Failed to fetch owner {owner_id}: {response.status}"
-                    )
-                    return owner_id, None
-        except Exception as e:
-            logging.error(f"Error fetching owner {owner_id}: {e}")
-            if attempt == max_retries - 1:
-                return owner_id, None
-            await asyncio.sleep(backoff_time)
+def resolve_owners(owner_ids):
+    """Look owner IDs up in the directory, refreshing it once if any are unknown."""
+    owner_ids = {str(owner_id) for owner_id in owner_ids if owner_id}
+    directory = load_owner_directory()
+    missing = owner_ids - directory.keys()
+    if missing and time.time() - _owner_directory_fetched_at > OWNER_REFRESH_COOLDOWN:
+        directory = load_owner_directory(force_refresh=True)
+        missing = owner_ids - directory.keys()
+    if missing:
+        logging.warning(f"Unknown owner IDs: {', '.join(sorted(missing))}")
+    return {owner_id: directory[owner_id] for owner_id in owner_ids if owner_id in directory}
 
-    return owner_id, None
+
+# Async wrapper for backward compatibility
+async def fetch_owner_details_async(owner_id):
+    owners = await asyncio.to_thread(resolve_owners, [owner_id])
+    return owner_id, owners.get(str(owner_id))
 
 
 # Sync wrapper for backward compatibility
 def fetch_owner_details(owner_id):
-    if owner_id in owner_details_cache:
-        return owner_details_cache[owner_id]
-    url = f"https://api.hubapi.com/crm/v3/owners/{owner_id}"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-    }
-    retries = 3
-    while retries > 0:
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            owner_details_cache[owner_id] = response.json()
-            return owner_details_cache[owner_id]
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Failed to fetch owner details for ID {owner_id}: {e}")
-            retries -= 1
-            if retries == 0:
-                raise
-            time.sleep(2 ** (3 - retries))  # Exponential backoff
+    return resolve_owners([owner_id]).get(str(owner_id))
 
 
-# Async function to fetch and attach owner details
-async def fetch_and_attach_owner_details_async(deals, owner_property, batch_size=10):
-    owner_ids = [
+def fetch_and_attach_owner_details(deals, owner_properties=OWNER_PROPERTIES):
+    """Attach <property>_details for each owner property from one directory lookup."""
+    if isinstance(owner_properties, str):
+        owner_properties = (owner_properties,)
+    owners = resolve_owners(
         deal["properties"].get(owner_property)
         for deal in deals
-        if deal["properties"].get(owner_property)
-    ]
-    unique_owner_ids = list(set(owner_ids))
-
-    sslcontext = ssl.create_default_context(cafile=certifi.where())
-    async with aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(ssl=sslcontext)
-    ) as session:
-        owners = {}
-
-        # Process in batches to avoid overwhelming the API
-        for i in range(0, len(unique_owner_ids), batch_size):
-            batch = unique_owner_ids[i : i + batch_size]
-            tasks = [fetch_owner_details_async(session, owner_id) for owner_id in batch]
-            results = await asyncio.gather(*tasks)
-
-            for owner_id, owner_data in results:
-                if owner_data:
-                    owners[owner_id] = owner_data
-
-            # Small delay between batches
-            if i + batch_size < len(unique_owner_ids):
-                await asyncio.sleep(0.5)
-
-    # Attach owner details to deals
+        for owner_property in owner_properties
+    )
     for deal in deals:
-        owner_id = deal["properties"].get(owner_property)
-        if owner_id:
-            deal[f"{owner_property}_details"] = owners.get(owner_id, {})
-
+        for owner_property in owner_properties:
+            owner_id = deal["properties"].get(owner_property)
+            if owner_id:
+                deal[f"{owner_property}_details"] = owners.get(str(owner_id), {})
     return deals
 
 
-# Sync wrapper for backward compatibility
-def fetch_and_attach_owner_details(deals, owner_property):
-    return asyncio.run(fetch_and_attach_owner_details_async(deals, owner_property))
+# Async wrapper for backward compatibility
+async def fetch_and_attach_owner_details_async(deals, owner_property):
+    return await asyncio.to_thread(fetch_and_attach_owner_details, deals, owner_property)
 
 
 def download_file(url):
-    response = requests.get(url)
+    response = hubspot.get(url)
     response.raise_for_status()
     return response.content
 
 
-def read_pdf(file_content):
-    pdf_reader = PyPDF2.PdfReader(BytesIO(file_content))
-    text = ""
-    for page_num in range(len(pdf_reader.pages)):
-        page = pdf_reader.pages[page_num]
-        text += page.extract_text()
-    return text
-
-
-def read_word(file_content):
-    doc = docx.Document(BytesIO(file_content))
-    text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-    return text
-
-
-def read_excel(file_content):
-    excel_file = pd.ExcelFile(BytesIO(file_content))
-    sheets = {}
-    for sheet_name in excel_file.sheet_names:
-        sheets[sheet_name] = excel_file.parse(sheet_name)
-    return sheets
-
-
-def read_ppt(file_content):
-    presentation = Presentation(BytesIO(file_content))
-    text = ""
-    for slide in presentation.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                text += shape.text + "\n"
-    return text
-
-
 def update_file_access(file_id, access_level):
-    url = f"https://api.hubapi.com/files/v3/files/{file_id}"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
     data = {"options": {"access": access_level}}
-    response = requests.patch(url, headers=headers, data=json.dumps(data))
+    response = hubspot.patch(f"/files/v3/files/{file_id}", data=json.dumps(data))
     response.raise_for_status()
     return response.json()
 
 
 def generate_signed_url(file_id):
-    url = f"https://api.hubapi.com/files/v3/files/{file_id}/signed-url"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    response = requests.get(url, headers=headers)
+    response = hubspot.get(f"/files/v3/files/{file_id}/signed-url")
     response.raise_for_status()
     return response.json()["url"]
 
 
 def get_file_details(file_id):
-    url = f"https://api.hubapi.com/files/v3/files/{file_id}"
-    headers = {"Authorization": f"Bearer {HUBSPOT_API_KEY}"}
-    response = requests.get(url, headers=headers)
+    response = hubspot.get(f"/files/v3/files/{file_id}")
     response.raise_for_status()
     return response.json()
 
@@ -255,37 +216,93 @@ def get_file_details(file_id):
 failed_attachments = []
 
 
+# Metadata cache for pipelines and property schemas: a per-process memo in
+# front of a disk TTL cache, revalidated with ETag/Last-Modified once expired
+metadata_cache = TTLCache("hubspot_metadata")
+METADATA_TTL = 60 * 60
+_metadata_memo = {}
+
+
+def get_hubspot_metadata(path, ttl=METADATA_TTL):
+    """GET a rarely-changing HubSpot resource through the metadata cache."""
+    memo = _metadata_memo.get(path)
+    if memo and memo[1] > time.time():
+        return memo[0]
+
+    entry = metadata_cache.entry(path)
+    if entry is not None:
+        value, expires_at, meta = entry
+        if expires_at is not None and expires_at > time.time():
+            _metadata_memo[path] = (value, expires_at)
+            return value
+
+    conditional_headers = {}
+    if entry is not None:
+        if entry[2].get("etag"):
+            conditional_headers["If-None-Match"] = entry[2]["etag"]
+        if entry[2].get("last_modified"):
+            conditional_headers["If-Modified-Since"] = entry[2]["last_modified"]
+
+    response = hubspot.get(path, headers=conditional_headers)
+    if response.status_code == 304 and entry is not None:
+        # Unchanged upstream; keep the cached body and extend its lifetime
+        value = entry[0]
+        metadata_cache.touch(path, ttl)
+    else:
+        response.raise_for_status()
+        value = response.json()
+        metadata_cache.set(
+            path,
+            value,
+            ttl=ttl,
+            meta={
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            },
+        )
+    _metadata_memo[path] = (value, time.time() + ttl)
+    return value
+
+
+def invalidate_metadata(path=None):
+    """Drop one cached metadata resource, or all of them."""
+    if path is None:
+        _metadata_memo.clear()
+        metadata_cache.clear()
+    else:
+        _metadata_memo.pop(path, None)
+        metadata_cache.delete(path)
+
+
 def fetch_deal_properties():
     """Fetch deal properties using v3 API."""
-    properties_url = "https://api.hubapi.com/crm/v3/properties/deals"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
+    return get_hubspot_metadata("/crm/v3/properties/deals").get("results", [])
+
+
+def get_property_option_labels(property_name, object_type="deals"):
+    """Map option values to labels for an enumeration property, e.g. fund."""
+    prop = get_hubspot_metadata(f"/crm/v3/properties/{object_type}/{property_name}")
+    return {
+        option.get("value"): option.get("label", option.get("value"))
+        for option in prop.get("options", [])
     }
-    response = requests.get(properties_url, headers=headers)
-    response.raise_for_status()
-    return response.json().get("results", [])
 
 
 def fetch_single_deal_with_history(deal_id):
-    properties_url = "https://api.hubapi.com/properties/v2/deals/properties"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    properties_url = "/properties/v2/deals/properties"
     # Fetch all deal properties
-    response = requests.get(properties_url, headers=headers)
+    response = hubspot.get(properties_url)
     if response.status_code == 200:
         deal_properties = response.json()
         all_properties = [prop["name"] for prop in deal_properties]
         # HubSpot API endpoint for fetching a single deal with property history
-        deal_url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
+        deal_url = f"/crm/v3/objects/deals/{deal_id}"
         params = {
             "propertiesWithHistory": ",".join(
                 all_properties
             )  # Fetch all properties with their history
         }
-        deal_response = requests.get(deal_url, headers=headers, params=params)
+        deal_response = hubspot.get(deal_url, params=params)
         if deal_response.status_code == 200:
             deal_info = deal_response.json()
             print(deal_info)
@@ -298,12 +315,8 @@ def fetch_single_deal_with_history(deal_id):
 
 
 def fetch_single_deal(deal_id):
-    properties_url = "https://api.hubapi.com/properties/v2/deals/properties"
-    url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    properties_url = "/properties/v2/deals/properties"
+    url = f"/crm/v3/objects/deals/{deal_id}"
     params = {
         "properties": [
             "dealname",
@@ -316,14 +329,14 @@ def fetch_single_deal(deal_id):
             "fund",
         ]
     }
-    properties_response = requests.get(properties_url, headers=headers)
+    properties_response = hubspot.get(properties_url)
     if properties_response.status_code == 200:
         deal_properties = properties_response.json()
         all_properties = [prop["name"] for prop in deal_properties]
     else:
         print(f"Error: {properties_response.status_code}")
     # Make the GET request to fetch the deal information
-    response = requests.get(url, headers=headers, params=params)
+    response = hubspot.get(url, params=params)
     # Check if the request was successful
     if response.status_code == 200:
         deal_info = response.json()
@@ -338,129 +351,123 @@ def fetch_deals_with_stage_history(start_date=None, end_date=None):
     )
 
 
-async def fetch_stage_history(session, deal_id, stage_mapping):
-    url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    params = {"propertiesWithHistory": "dealstage"}
-    max_retries = 5
-    backoff_time = 2  # Initial backoff time in seconds
-    for attempt in range(max_retries):
-        async with session.get(url, headers=headers, params=params) as response:
-            if response.status == 200:
-                deal_stage_history = await response.json()
-                deal_stage_history = deal_stage_history["propertiesWithHistory"][
-                    "dealstage"
-                ]
-                for stage in deal_stage_history:
-                    stage_id = stage["value"]
-                    stage["stage_name"] = stage_mapping.get(stage_id, "Unknown Stage")
-                return deal_id, deal_stage_history
-            elif response.status == 429:  # Rate limit error
-                print(
-                    f"Rate limit hit: waiting {backoff_time} seconds before retrying..."
-                )
-                await asyncio.sleep(backoff_time)
-                backoff_time *= 2  # Exponentially increase backoff time
-            else:
-                print(
-                    f"Failed to retrieve deal data: {response.status} {await response.text()}"
-                )
-                return deal_id, None
-    print(f"Max retries reached for deal {deal_id}.")
-    return deal_id, None
+# CRM batch read accepts up to 100 record IDs per request
+STAGE_HISTORY_BATCH_SIZE = 100
 
 
-async def fetch_all_stage_histories(
-    deals, stage_mapping, batch_size=140, delay_between_batches=10
-):
-    sslcontext = ssl.create_default_context(cafile=certifi.where())
-    async with aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(ssl=sslcontext)
-    ) as session:
-        stage_histories = {}
-        for i in range(0, len(deals), batch_size):
-            batch = deals[i : i + batch_size]
-            tasks = [
-                fetch_stage_history(session, deal["id"], stage_mapping)
-                for deal in batch
-            ]
-            results = await asyncio.gather(*tasks)
-            stage_histories.update(
-                {deal_id: history for deal_id, history in results if history}
+def annotate_stage_history(deal_stage_history, stage_mapping):
+    for stage in deal_stage_history:
+        stage_id = stage["value"]
+        stage["stage_name"] = stage_mapping.get(stage_id, "Unknown Stage")
+    return deal_stage_history
+
+
+async def fetch_stage_history_batch(deal_ids, stage_mapping):
+    """
+    Fetch dealstage history for up to 100 deals with one batch read.
+    Returns None if the read failed, so callers can tell it from "no history".
+    """
+    body = {
+        "inputs": [{"id": deal_id} for deal_id in deal_ids],
+        "properties": ["dealstage"],
+        "propertiesWithHistory": ["dealstage"],
+    }
+    async with hubspot.request_async(
+        "POST", "/crm/v3/objects/deals/batch/read", json=body
+    ) as response:
+        # 207 means some IDs failed; the rest are still in "results"
+        if response.status not in (200, 207):
+            print(
+                f"Failed to retrieve stage histories: {response.status} {await response.text()}"
             )
-            # Delay between batches to avoid hitting rate limits
-            await asyncio.sleep(delay_between_batches)
-        return stage_histories
-
-
-async def fetch_and_attach_notes(deals, batch_size=4, delay_between_batches=1):
-    sslcontext = ssl.create_default_context(cafile=certifi.where())
-    async with aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(ssl=sslcontext)
-    ) as session:
-        notes = {}
-        for i in range(0, len(deals), batch_size):
-            batch = deals[i : i + batch_size]
-            tasks = [fetch_notes(session, deal["id"]) for deal in batch]
-            results = await asyncio.gather(*tasks)
-            notes.update({deal_id: note for deal_id, note in results if note})
-            # Delay between batches
-            await asyncio.sleep(delay_between_batches)
-        for deal in deals:
-            deal_id = deal["id"]
-            deal_notes = notes.get(deal_id)
-            deal["notes"] = deal_notes["results"]
-        return deals
+            return None
+        data = await response.json()
 
+    return {
+        result["id"]: annotate_stage_history(
+            result.get("propertiesWithHistory", {}).get("dealstage", []),
+            stage_mapping,
+        )
+        for result in data.get("results", [])
+    }
 
-# DEPRECATED - Use fetch_deals() instead
-def fetch_all_deals(start_date=None, end_date=None):
-    return fetch_deals(start_date=start_date, end_date=end_date)
 
+async def fetch_stage_history(deal_id, stage_mapping):
+    histories = await fetch_stage_history_batch([deal_id], stage_mapping)
+    return deal_id, (histories or {}).get(deal_id)
 
-def fetch_deals_and_stage_histories(start_date=None, end_date=None):
-    """Fetch deals with stage histories and owner details - optimized version."""
-    deals = fetch_deals(start_date, end_date)
 
-    # Run both owner fetches in parallel using async
-    async def fetch_all_owners():
-        await asyncio.gather(
-            fetch_and_attach_owner_details_async(deals, "hubspot_owner_id"),
-            fetch_and_attach_owner_details_async(deals, "team_member_1"),
+async def fetch_all_stage_histories(deals, stage_mapping):
+    """Returns ({deal_id: history}, IDs whose history couldn't be read)."""
+    deal_ids = [deal["id"] for deal in deals]
+    batches = [
+        deal_ids[i : i + STAGE_HISTORY_BATCH_SIZE]
+        for i in range(0, len(deal_ids), STAGE_HISTORY_BATCH_SIZE)
+    ]
+    # Batches run concurrently under the shared rate governor
+    results = await asyncio.gather(
+        *[fetch_stage_history_batch(batch, stage_mapping) for batch in batches]
+    )
+    stage_histories, failed = {}, set()
+    for batch, histories in zip(batches, results):
+        if histories is None:
+            failed.update(batch)
+            continue
+        # IDs a 207 left out of "results" failed individually
+        failed.update(deal_id for deal_id in batch if deal_id not in histories)
+        stage_histories.update(
+            {deal_id: history for deal_id, history in histories.items() if history}
         )
+    return stage_histories, failed
+
 
-    asyncio.run(fetch_all_owners())
+def attach_stage_histories(deals, stage_mapping=None):
+    """Attach deal_stage_history; returns the IDs whose history couldn't be read."""
+    if stage_mapping is None:
+        stage_mapping = get_stage_mapping()
+    stage_histories, failed = hubspot.run(
+        fetch_all_stage_histories(deals, stage_mapping)
+    )
+    for deal in deals:
+        deal["deal_stage_history"] = stage_histories.get(deal["id"], [])
+    return failed
 
-    # Fetch all stage histories asynchronously with batching and delays
-    stage_mapping = get_stage_mapping()
-    stage_histories = asyncio.run(fetch_all_stage_histories(deals, stage_mapping))
 
-    # Merge the stage histories into the deals
+async def fetch_and_attach_notes(deals):
+    notes = await fetch_notes_for_deals([deal["id"] for deal in deals])
     for deal in deals:
-        deal_id = deal["id"]
-        deal["deal_stage_history"] = stage_histories.get(deal_id, [])
+        deal["notes"] = notes.get(deal["id"]) or []
+    return deals
 
+
+# DEPRECATED - Use fetch_deals() instead
+def fetch_all_deals(start_date=None, end_date=None):
+    return fetch_deals(start_date=start_date, end_date=end_date)
+
+
+def attach_all_owner_details(deals):
+    # Lead owner and support member resolve in one pass over the owner directory
+    return fetch_and_attach_owner_details(deals, OWNER_PROPERTIES)
+
+
+def fetch_deals_and_stage_histories(start_date=None, end_date=None):
+    """Fetch deals with stage histories and owner details - optimized version."""
+    # Stage histories of unchanged deals come from the local store
+    deals = fetch_deals(start_date, end_date, include_stage_history=True)
+    attach_all_owner_details(deals)
     return deals
 
 
-def fetch_deals(start_date=None, end_date=None, include_stage_history=False):
-    properties = [
-        "dealname",
-        "priority",
-        "referral_type",
-        "pipeline",
-        "broad_category_updated",
-        "subcategory",
-        "fund",
-        "hubspot_owner_id",
-        "team_member_1",
-        "createdate",
-        "keywords",
-    ]
-    deals = []
+# HubSpot search returns at most 10,000 results per query; windows that come
+# back close to that are split so large ranges are never truncated
+SEARCH_PAGE_SIZE = 100
+SEARCH_RESULT_CAP = 10000
+SEARCH_SPLIT_THRESHOLD = 9000
+DEAL_WINDOW_DAYS = 30
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def createdate_range_ms(start_date=None, end_date=None):
     if start_date is None and end_date is None:
         start_date = str(datetime.now().date() + relativedelta(months=-3))
         end_date = str(datetime.now().date() + relativedelta(days=+1))
@@ -470,88 +477,278 @@ def fetch_deals(start_date=None, end_date=None, include_stage_history=False):
     start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
     end_date = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
     # Convert the close date to a Unix timestamp in milliseconds
-    start_date = int(start_date.timestamp() * 1000)
-    end_date = int(end_date.timestamp() * 1000)
-    after = None
+    return int(start_date.timestamp() * 1000), int(end_date.timestamp() * 1000)
+
+
+def createdate_windows(start_ms, end_ms, window_days=DEAL_WINDOW_DAYS):
+    """Split an inclusive [start_ms, end_ms] range into non-overlapping windows."""
+    step = window_days * DAY_MS
+    windows = []
+    window_start = start_ms
+    while window_start <= end_ms:
+        window_end = min(window_start + step - 1, end_ms)
+        windows.append((window_start, window_end))
+        window_start = window_end + 1
+    return windows
+
+
+def deal_search_body(start_ms, end_ms, properties, after=None, modified_since=None):
+    search_body = {
+        "filterGroups": [
+            {
+                "filters": [
+                    {
+                        "propertyName": "createdate",
+                        "operator": "BETWEEN",
+                        "highValue": end_ms,
+                        "value": start_ms,
+                    },
+                    {
+                        "propertyName": "pipeline",
+                        "operator": "EQ",
+                        "value": "default",
+                    },
+                ]
+            }
+        ],
+        "properties": properties,
+        "limit": SEARCH_PAGE_SIZE,
+    }
+    if modified_since is not None:
+        search_body["filterGroups"][0]["filters"].append(
+            {
+                "propertyName": "hs_lastmodifieddate",
+                "operator": "GTE",
+                "value": modified_since,
+            }
+        )
+    if after:
+        search_body["after"] = after
+    return search_body
+
 
-    max_retries = 3
+async def search_hubspot_object_async(object_type, search_body, max_retries=3):
     base_delay = 0.5
+    for attempt in range(max_retries):
+        try:
+            async with hubspot.request_async(
+                "POST", f"/crm/v3/objects/{object_type}/search", json=search_body
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+        except Exception as e:
+            if attempt < max_retries - 1:
+                await asyncio.sleep(base_delay * (attempt + 1) ** 2)
+            else:
+                print(f"Attempt {attempt + 1} failed: {e}. No more retries left.")
+                raise
 
-    search_results = None
 
+async def fetch_deal_window(start_ms, end_ms, properties, modified_since=None):
+    """Paginate one createdate window, splitting it if it nears the search cap."""
+    search_results = await search_hubspot_object_async(
+        "deals",
+        deal_search_body(start_ms, end_ms, properties, modified_since=modified_since),
+    )
+    if search_results.get("total", 0) > SEARCH_SPLIT_THRESHOLD and end_ms > start_ms:
+        mid = (start_ms + end_ms) // 2
+        left, right = await asyncio.gather(
+            fetch_deal_window(start_ms, mid, properties, modified_since),
+            fetch_deal_window(mid + 1, end_ms, properties, modified_since),
+        )
+        return left + right
+    if search_results.get("total", 0) > SEARCH_RESULT_CAP:
+        logging.warning(
+            f"Deal window {start_ms}-{end_ms} exceeds the search cap and will be truncated"
+        )
+
+    deals = []
     while True:
-        search_body = {
-            "filterGroups": [
-                {
-                    "filters": [
-                        {
-                            "propertyName": "createdate",
-                            "operator": "BETWEEN",
-                            "highValue": end_date,
-                            "value": start_date,
-                        },
-                        {
-                            "propertyName": "pipeline",
-                            "operator": "EQ",
-                            "value": "default",
-                        },
-                    ]
-                }
-            ],
-            "properties": properties,
-            "limit": 100,
-        }
-        if after:
-            search_body["after"] = after
+        deals.extend(search_results.get("results", []))
+        pagination = search_results.get("paging", [])
+        if not (pagination and "next" in pagination):
+            break
+        search_results = await search_hubspot_object_async(
+            "deals",
+            deal_search_body(
+                start_ms,
+                end_ms,
+                properties,
+                after=pagination["next"]["after"],
+                modified_since=modified_since,
+            ),
+        )
+    return deals
 
-        for attempt in range(max_retries):
-            try:
-                search_results = search_hubspot_object("deals", search_body)
-                break
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    delay = base_delay * (attempt**2)
-                    time.sleep(delay)
-                else:
-                    print(f"Attempt {attempt + 1} failed: {e}. No more retries left.")
-                    raise
-
-        fetched_deals = search_results.get("results", [])
-
-        # If including stage history, fetch it inline
-        if include_stage_history:
-            stage_mapping = get_stage_mapping()
-            for deal in fetched_deals:
-                deal_id = deal["id"]
-                url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
-                headers = {
-                    "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-                    "Content-Type": "application/json",
-                }
-                params = {"propertiesWithHistory": "dealstage"}
-                response = requests.get(url, headers=headers, params=params)
-                if response.status_code == 200:
-                    deal_stage_history = response.json()["propertiesWithHistory"][
-                        "dealstage"
-                    ]
-                    for stage in deal_stage_history:
-                        stage_id = stage["value"]
-                        stage["stage_name"] = stage_mapping.get(
-                            stage_id, "Unknown Stage"
-                        )
-                    deal["deal_stage_history"] = deal_stage_history
-                else:
-                    logging.error(
-                        f"Failed to retrieve stage history: {response.status_code}"
-                    )
-                    deal["deal_stage_history"] = []
 
-        deals.extend(fetched_deals)
-        pagination = search_results.get("paging", [])
-        if pagination and "next" in pagination:
-            after = pagination["next"]["after"]
+async def fetch_deal_windows(start_ms, end_ms, properties, modified_since=None):
+    # Date windows are paginated concurrently under the shared search budget
+    window_results = await asyncio.gather(
+        *[
+            fetch_deal_window(window_start, window_end, properties, modified_since)
+            for window_start, window_end in createdate_windows(start_ms, end_ms)
+        ]
+    )
+    # Merge windows in date order, de-duplicated by deal id
+    deals_by_id = {}
+    for window_deals in window_results:
+        for deal in window_deals:
+            deals_by_id.setdefault(deal["id"], deal)
+    return list(deals_by_id.values())
+
+
+# Local deal store; unchanged deals and enrichments are served from here
+deal_store = DealStore()
+# Allow for HubSpot search indexing lag when advancing the high-water mark
+SYNC_SKEW_MS = 5 * 60 * 1000
+# Force a full resync of a window periodically to drop deleted/moved deals
+FULL_RESYNC_AFTER_SECONDS = 7 * 24 * 60 * 60
+
+
+def sync_deals(start_ms, end_ms, properties):
+    """
+    Incrementally sync deals created in [start_ms, end_ms] into the local store.
+
+    If a stored window overlaps the range, only deals modified since its
+    high-water mark are pulled for it; any part of the range outside it is
+    fetched in full. The two are merged into one window.
+    """
+    query_key = DealStore.query_key(properties)
+    sync_started_ms = int(time.time() * 1000)
+    window = deal_store.overlapping_window(
+        query_key, start_ms, end_ms, max_age=FULL_RESYNC_AFTER_SECONDS
+    )
+
+    if window is None:
+        # No current window: the whole range is fetched in full
+        old_window, merged = None, (start_ms, end_ms)
+        full_ranges = [(start_ms, end_ms)]
+    else:
+        window_start, window_end, _ = window
+        old_window = (window_start, window_end)
+        merged = (min(start_ms, window_start), max(end_ms, window_end))
+        full_ranges = []
+        if start_ms < window_start:
+            full_ranges.append((start_ms, window_start - 1))
+        if end_ms > window_end:
+            full_ranges.append((window_end + 1, end_ms))
+
+    async def fetch_changes():
+        tasks = [
+            fetch_deal_windows(range_start, range_end, properties)
+            for range_start, range_end in full_ranges
+        ]
+        if window is not None:
+            tasks.append(
+                fetch_deal_windows(*old_window, properties, modified_since=window[2])
+            )
+        return await asyncio.gather(*tasks)
+
+    results = hubspot.run(fetch_changes())
+    # Fully fetched ranges replace what was stored for them, so deals deleted
+    # in HubSpot drop out; the modified-since pull can only add and update
+    full = [
+        (range_start, range_end, deals)
+        for (range_start, range_end), deals in zip(full_ranges, results)
+    ]
+    changed = results[len(full_ranges)] if window is not None else []
+    deal_store.store_sync(
+        query_key, full, changed, old_window, *merged, sync_started_ms - SYNC_SKEW_MS
+    )
+    fetched = sum(len(deals) for _, _, deals in full)
+    if window is None:
+        logging.info(f"Full sync: {fetched} deals stored")
+    else:
+        logging.info(
+            f"Incremental sync: {len(changed)} deals new or changed, "
+            f"{fetched} fetched outside the stored window"
+        )
+    return deal_store.deals_in_range(query_key, start_ms, end_ms)
+
+
+def enrich_from_store(deals, kind, keys, fetch):
+    """
+    Reuse stored enrichment ``keys`` for deals whose hs_lastmodifieddate is
+    unchanged since they were enriched; call ``fetch(stale_deals)`` for the rest.
+
+    ``fetch`` attaches the keys and returns the IDs it couldn't fetch fully.
+    Those deals keep whatever was attached for this run but are not stored,
+    so a failed request isn't served as "no data" until the deal changes.
+    """
+    cached = deal_store.get_enrichments([deal["id"] for deal in deals], kind)
+    stale = []
+    for deal in deals:
+        modified = deal["properties"].get("hs_lastmodifieddate")
+        hit = cached.get(str(deal["id"]))
+        if hit and modified and hit[0] == modified:
+            deal.update(hit[1])
         else:
-            break
+            stale.append(deal)
+    if stale:
+        failed = {str(deal_id) for deal_id in fetch(stale) or ()}
+        deal_store.put_enrichments(
+            kind,
+            {
+                deal["id"]: (
+                    deal["properties"].get("hs_lastmodifieddate"),
+                    {key: deal.get(key) for key in keys},
+                )
+                for deal in stale
+                if str(deal["id"]) not in failed
+            },
+        )
+        if failed:
+            logging.warning(
+                f"{kind}: {len(failed)} deals not stored after fetch errors; "
+                "they are refetched next run"
+            )
+    logging.info(f"{kind}: {len(deals) - len(stale)} from store, {len(stale)} fetched")
+    return deals
+
+
+DEAL_PROPERTIES = [
+    "dealname",
+    "priority",
+    "referral_type",
+    "pipeline",
+    "broad_category_updated",
+    "subcategory",
+    "fund",
+    "hubspot_owner_id",
+    "team_member_1",
+    "createdate",
+    "keywords",
+    "hs_lastmodifieddate",
+]
+
+
+def deal_properties(extra_properties=None):
+    properties = list(DEAL_PROPERTIES)
+    if extra_properties:
+        properties += [p for p in extra_properties if p not in properties]
+    return properties
+
+
+def fetch_deals(
+    start_date=None,
+    end_date=None,
+    include_stage_history=False,
+    extra_properties=None,
+    use_store=True,
+):
+    properties = deal_properties(extra_properties)
+    start_ms, end_ms = createdate_range_ms(start_date, end_date)
+
+    if use_store:
+        deals = sync_deals(start_ms, end_ms, properties)
+    else:
+        deals = hubspot.run(fetch_deal_windows(start_ms, end_ms, properties))
+
+    # If including stage history, batch-read it for every page at once
+    if include_stage_history:
+        enrich_from_store(
+            deals, "stage_history", ["deal_stage_history"], attach_stage_histories
+        )
     return deals
 
 
@@ -593,17 +790,31 @@ def create_openai_client(OPEN_AI_KEY):
 
 
 openai_client = create_openai_client(OPEN_AI_KEY)
+# Used on the HubSpot client's event loop for real-time runs
+async_openai_client = openai.AsyncOpenAI(api_key=OPEN_AI_KEY)
 
 gpt_errors = []
 
 
+def deal_prompt(deal):
+    """
+    User message for one deal (the compact, token-budgeted serialization)
+    and its token count. Kept on the deal as "prompt", so the cache key,
+    real-time sizing and request building share one serialization.
+    """
+    if deal.get("prompt") is None:
+        user_content = f"Deal info: {serialize_deal(deal)}"
+        deal["prompt"] = (user_content, count_tokens(user_content))
+    return deal["prompt"]
+
+
 def parse_with_chatgpt(openai_client, deal):
     try:
         messages = [
             {"role": "system", "content": gpt_prompt},
             {
                 "role": "user",
-                "content": f"Deal info: {deal}",
+                "content": deal_prompt(deal)[0],
             },
         ]
         response = openai_client.chat.completions.create(
@@ -627,75 +838,260 @@ system_prompt_for_final_path = "data/system_prompt_for_final.txt"
 system_prompt_for_final = read_prompt_text(system_prompt_for_final_path)
 
 
-def batch_with_chatgpt(openai_client, deals):
-    jsonl_lines = []
-    for deal in deals:
-        prompt = {
-            "custom_id": str(uuid.uuid4()),
-            "method": "POST",
-            "url": "/v1/chat/completions",
-            "body": {
-                "model": "gpt-4o",
-                "response_format": {"type": "json_object"},
-                "messages": [
-                    {"role": "system", "content": gpt_prompt},
-                    {"role": "user", "content": f"Deal info: {deal}"},
-                ],
-                "max_tokens": 2500,
-                "n": 1,
-                "stop": None,
-                "temperature": 0.5,
-            },
-        }
-        jsonl_lines.append(json.dumps(prompt).encode("utf-8"))
-    json_memory_file = io.BytesIO()
-    for line in jsonl_lines:
-        json_memory_file.write(line + b"\n")
-    json_memory_file.seek(0)
-    batch_input_file = openai_client.files.create(
-        file=json_memory_file, purpose="batch"
-    )
-    batch_input_file_id = batch_input_file.id
-    batch = openai_client.batches.create(
-        input_file_id=batch_input_file_id,
+# Batch API limits per batch file, with a margin on size. The enqueued-token
+# limit is per organization across all batches in flight and depends on the
+# account tier, so it is configurable; GptJobRunner only creates batches
+# while the job stays under it. Smaller shards also finish (and stream back)
+# sooner than one large batch.
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+BATCH_MAX_ENQUEUED_TOKENS = int(os.getenv("OPENAI_BATCH_TOKEN_LIMIT", "2000000"))
+BATCH_SHARD_REQUESTS = min(int(os.getenv("OPENAI_BATCH_SHARD_REQUESTS", "1000")), BATCH_MAX_REQUESTS)
+RECOMMENDATION_MODEL = "gpt-4o"
+RECOMMENDATION_MAX_TOKENS = 2500
+BATCH_SUBMIT_WORKERS = 8
+# Per-message overhead of the chat format, in tokens
+CHAT_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def recommendation_request(deal, system_tokens=None):
+    """Chat completion body for a deal's recommendation, with its estimated prompt tokens."""
+    user_content, user_tokens = deal_prompt(deal)
+    body = {
+        "model": RECOMMENDATION_MODEL,
+        "response_format": {"type": "json_object"},
+        "messages": [
+            {"role": "system", "content": gpt_prompt},
+            {"role": "user", "content": user_content},
+        ],
+        "max_tokens": RECOMMENDATION_MAX_TOKENS,
+        "n": 1,
+        "stop": None,
+        "temperature": 0.5,
+    }
+    if system_tokens is None:
+        system_tokens = count_tokens(gpt_prompt)
+    tokens = system_tokens + user_tokens + 2 * CHAT_MESSAGE_OVERHEAD_TOKENS
+    return body, tokens
+
+
+def batch_request_line(deal, system_tokens=None):
+    """One JSONL request for a deal, with its estimated prompt tokens."""
+    body, tokens = recommendation_request(deal, system_tokens)
+    prompt = {
+        # The deal ID, so results join back to deals exactly
+        "custom_id": str(deal["id"]),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": body,
+    }
+    return json.dumps(prompt).encode("utf-8") + b"\n", tokens
+
+
+def plan_batch_shards(
+    lines,
+    max_requests=BATCH_SHARD_REQUESTS,
+    max_bytes=BATCH_MAX_BYTES,
+    max_tokens=BATCH_MAX_ENQUEUED_TOKENS,
+):
+    """
+    Split ``(line, tokens)`` pairs into ``(lines, tokens)`` shards under the
+    request-count, file-size and enqueued-token limits, keeping input order.
+    """
+    shards = []
+    current, current_bytes, current_tokens = [], 0, 0
+    for line, tokens in lines:
+        if current and (
+            len(current) >= max_requests
+            or current_bytes + len(line) > max_bytes
+            or current_tokens + tokens > max_tokens
+        ):
+            shards.append((current, current_tokens))
+            current, current_bytes, current_tokens = [], 0, 0
+        current.append(line)
+        current_bytes += len(line)
+        current_tokens += tokens
+    if current:
+        shards.append((current, current_tokens))
+    return shards
+
+
+def create_batch(openai_client, input_file_id):
+    return openai_client.batches.create(
+        input_file_id=input_file_id,
         endpoint="/v1/chat/completions",
         completion_window="24h",
         metadata={"description": "deal data recommendation generator"},
     )
-    return batch
-
-
-def check_gpt(openai_client, batch):
-    # check status
-    file_response = None
-    retrieved_batch = openai_client.batches.retrieve(batch.id)
-    if retrieved_batch.status == "completed" and retrieved_batch.output_file_id:
-        file_response = openai_client.files.content(retrieved_batch.output_file_id)
-        return file_response.content
-    elif retrieved_batch.status == "completed" and retrieved_batch.error_file_id:
-        file_response = openai_client.files.content(retrieved_batch.error_file_id)
-        raise Exception(
-            f"Batch processing failed. Error details: {file_response.content}"
+
+
+def upload_batch_shard(openai_client, shard):
+    lines, tokens = shard
+    json_memory_file = io.BytesIO(b"".join(lines))
+    batch_input_file = openai_client.files.create(
+        file=json_memory_file, purpose="batch"
+    )
+    return {"input_file_id": batch_input_file.id, "tokens": tokens}
+
+
+# Parsed GPT results keyed on a hash of the exact prompt input, so deals
+# whose serialized data, prompt and model are unchanged skip the batch
+recommendation_cache = TTLCache("gpt_recommendations")
+RECOMMENDATION_CACHE_TTL = 90 * 24 * 60 * 60
+
+
+def recommendation_key(deal, model=RECOMMENDATION_MODEL):
+    payload = json.dumps([model, gpt_prompt, deal_prompt(deal)[0]])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def apply_cached_recommendations(deals, model=RECOMMENDATION_MODEL):
+    """Attach cached "parsed" results; returns the deals that still need GPT."""
+    pending = []
+    for deal in deals:
+        parsed = recommendation_cache.get(recommendation_key(deal, model))
+        if parsed is not None:
+            deal["parsed"] = parsed
+        else:
+            pending.append(deal)
+    logging.info(
+        f"Reusing cached recommendations for {len(deals) - len(pending)} of {len(deals)} deals"
+    )
+    return pending
+
+
+def cache_recommendation(deal, model=RECOMMENDATION_MODEL):
+    if deal.get("parsed"):
+        recommendation_cache.set(
+            recommendation_key(deal, model), deal["parsed"], ttl=RECOMMENDATION_CACHE_TTL
         )
-    elif retrieved_batch.status == "failed":
-        raise Exception(f"Batch processing failed. Error details: {retrieved_batch}")
-    else:
-        return None
 
 
-def poll_gpt_check(check):
-    if isinstance(check, bytes):
-        result = check
-        memory_file = io.BytesIO()
-        memory_file.write(result)
-        memory_file.seek(0)
-        memory_text = io.StringIO(memory_file.getvalue().decode("utf-8"))
-        results = []
-        # Read from the in-memory text stream
-        for line in memory_text:
-            json_object = json.loads(line.strip())
-            results.append(json_object)
-        return results
+def upload_batch_shards(openai_client, deals):
+    """
+    Plan shards for ``deals`` and upload their input files concurrently.
+    Returns ``[{"input_file_id", "tokens"}]``; batches are created from them
+    by GptJobRunner as the enqueued-token limit allows.
+    """
+    system_tokens = count_tokens(gpt_prompt)
+    shards = plan_batch_shards(
+        batch_request_line(deal, system_tokens) for deal in deals
+    )
+    logging.info(f"Uploading {len(deals)} deals as {len(shards)} batch shard(s)")
+    if not shards:
+        return []
+    with ThreadPoolExecutor(max_workers=min(BATCH_SUBMIT_WORKERS, len(shards))) as executor:
+        return list(
+            executor.map(lambda shard: upload_batch_shard(openai_client, shard), shards)
+        )
+
+
+# Runs at most this size go through concurrent real-time completions, which
+# finish in seconds; larger ones use the (cheaper, slower) batch API
+REALTIME_MAX_DEALS = int(os.getenv("OPENAI_REALTIME_MAX_DEALS", "50"))
+# Share of the function's time budget the real-time completions may take;
+# the path has no checkpoint, so fetching and write-back need the rest
+REALTIME_TIME_SHARE = 0.5
+
+# Shared across invocations, so limits learned from response headers carry
+# over to later runs on a warm instance
+realtime_limiter = OpenAIRateLimiter()
+
+
+def prefer_realtime(deals, limiter=None):
+    """
+    Whether ``deals`` fit through the limiter's current requests/tokens per
+    minute within REALTIME_TIME_SHARE of the function time budget.
+    """
+    if not deals or len(deals) > REALTIME_MAX_DEALS:
+        return False
+    requests_per_minute, tokens_per_minute = (limiter or realtime_limiter).per_minute()
+    minutes = GPT_JOB_TIME_BUDGET * REALTIME_TIME_SHARE / 60
+    system_tokens = count_tokens(gpt_prompt)
+    # The tokens/minute limit counts max_tokens as well as the prompt
+    estimated = sum(
+        recommendation_request(deal, system_tokens)[1] + RECOMMENDATION_MAX_TOKENS
+        for deal in deals
+    )
+    return (
+        len(deals) <= requests_per_minute * minutes
+        and estimated <= tokens_per_minute * minutes
+    )
+
+
+def recommend_realtime(deals, client=None):
+    """
+    Recommendations for ``deals`` via concurrent chat completions.
+
+    Attaches "parsed" and caches each result; failures are logged to
+    gpt_errors. Returns the number of deals parsed.
+    """
+    client = client or async_openai_client
+    system_tokens = count_tokens(gpt_prompt)
+    requests_by_id = {}
+    for deal in deals:
+        body, tokens = recommendation_request(deal, system_tokens)
+        # The tokens/minute limit counts max_tokens as well as the prompt
+        requests_by_id[str(deal["id"])] = (body, tokens + RECOMMENDATION_MAX_TOKENS)
+    results = hubspot.run(complete_all(client, requests_by_id, limiter=realtime_limiter))
+
+    parsed_count = 0
+    for deal in deals:
+        result = results.get(str(deal["id"]))
+        try:
+            if isinstance(result, Exception):
+                raise result
+            deal["parsed"] = json.loads(result)
+        except Exception as e:
+            gpt_errors.append({deal["id"]: str(e)})
+            logging.warning(f"Real-time recommendation failed for deal {deal['id']}: {e}")
+            continue
+        cache_recommendation(deal)
+        parsed_count += 1
+    return parsed_count
+
+
+# Checkpoints for resumable GPT jobs (see gpt_jobs.GptJobRunner)
+gpt_job_checkpoints = TTLCache("gpt_jobs")
+
+
+def gpt_job_runner(client=None):
+    client = client or openai_client
+
+    def cache_match(entry, parsed):
+        if entry.get("cache_key"):
+            recommendation_cache.set(
+                entry["cache_key"], parsed, ttl=RECOMMENDATION_CACHE_TTL
+            )
+
+    return GptJobRunner(
+        client,
+        gpt_job_checkpoints,
+        upload=lambda deals: upload_batch_shards(client, deals),
+        create_batch=lambda input_file_id: create_batch(client, input_file_id),
+        write=update_hubspot_keywords_batch,
+        on_match=cache_match,
+        token_limit=BATCH_MAX_ENQUEUED_TOKENS,
+    )
+
+
+def start_recommendation_job(deals, client=None, pending=None):
+    """
+    Reuse cached recommendations, submit the rest, and checkpoint a new job.
+    ``pending`` skips the cache lookup when the caller already did it.
+    """
+    if pending is None:
+        pending = apply_cached_recommendations(deals)
+    return gpt_job_runner(client).start(
+        pending,
+        cache_keys={str(deal["id"]): recommendation_key(deal) for deal in pending},
+        parsed={str(deal["id"]): deal["parsed"] for deal in deals if deal.get("parsed")},
+        # Fetched keywords, so write-back can skip deals that already match
+        current={
+            str(deal["id"]): {"keywords": deal.get("properties", {}).get("keywords")}
+            for deal in deals
+        },
+    )
 
 
 def delete_batch_file(openai_client, batch):
@@ -708,36 +1104,127 @@ def delete_batch_file(openai_client, batch):
     openai_client.files.delete(batch.output_file_id)
 
 
+group_prompt_for_compile_path = "data/group_prompt_for_compile.txt"
+group_prompt_for_compile = read_prompt_text(group_prompt_for_compile_path)
+
+COMPILE_MODEL = "gpt-5"
+# Groups bigger than this are summarized in chunks, then merged
+COMPILE_CHUNK_TOKENS = int(os.getenv("COMPILE_CHUNK_TOKENS", "30000"))
+# Per-category summaries, keyed on the category's deals, prompt and model
+compile_summary_cache = TTLCache("compile_summaries")
+COMPILE_SUMMARY_TTL = 30 * 24 * 60 * 60
+
+
+def compile_request(system_prompt, user_content):
+    return {
+        "model": COMPILE_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ],
+        "max_tokens": 2500,
+        "n": 1,
+        "stop": None,
+        "temperature": 0.5,
+    }
+
+
+async def complete_compile(client, limiter, system_prompt, user_content):
+    request = compile_request(system_prompt, user_content)
+    tokens = count_tokens(system_prompt) + count_tokens(user_content) + request["max_tokens"]
+    return await complete(client, limiter, request, tokens)
+
+
+def chunk_by_tokens(items, max_tokens=COMPILE_CHUNK_TOKENS):
+    chunks, current, current_tokens = [], [], 0
+    for item in items:
+        tokens = count_tokens(json.dumps(item, default=str))
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def summarize_category(client, limiter, broad_category, deals):
+    """Map step: one summary per broad category, chunked and merged if it's large."""
+    key = hashlib.sha256(
+        json.dumps(
+            [COMPILE_MODEL, group_prompt_for_compile, broad_category, deals],
+            sort_keys=True,
+            default=str,
+        ).encode("utf-8")
+    ).hexdigest()
+    cached = compile_summary_cache.get(key)
+    if cached is not None:
+        return cached
+
+    partials = await asyncio.gather(
+        *[
+            complete_compile(
+                client,
+                limiter,
+                group_prompt_for_compile,
+                f"Broad category: {broad_category} - Deals: {json.dumps(chunk, default=str)}",
+            )
+            for chunk in chunk_by_tokens(deals)
+        ]
+    )
+    summary = partials[0]
+    if len(partials) > 1:
+        summary = await complete_compile(
+            client,
+            limiter,
+            group_prompt_for_compile,
+            f"Broad category: {broad_category} - Summaries: {json.dumps(partials)}",
+        )
+    compile_summary_cache.set(key, summary, ttl=COMPILE_SUMMARY_TTL)
+    return summary
+
+
+async def compile_deals(client, cleaned_deals, limiter=None):
+    """
+    Summarize every broad category concurrently, then reduce with the final
+    prompt. Requests go through ``limiter`` (the shared realtime_limiter by
+    default), so they count against the same learned limits as real-time
+    recommendations.
+    """
+    limiter = limiter or realtime_limiter
+    groups = organize_cleaned_deals(cleaned_deals)
+    summaries = await asyncio.gather(
+        *[
+            summarize_category(client, limiter, broad_category, deals)
+            for broad_category, deals in groups.items()
+        ]
+    )
+    category_summaries = dict(zip(map(str, groups), summaries))
+    return await complete_compile(
+        client,
+        limiter,
+        system_prompt_for_final,
+        f"Context: {user_prompt_for_final} - Input Data: {json.dumps(category_summaries)}",
+    )
+
+
 def compile_with_chatgpt(openai_client, cleaned_deals):
+    """
+    Map-reduce over broad categories (see compile_deals). Runs on the async
+    client, so ``openai_client`` is only kept for existing callers.
+    """
     try:
-        messages = [
-            {"role": "system", "content": system_prompt_for_final},
-            {
-                "role": "user",
-                "content": f"Context: {user_prompt_for_final} - Input Data: {cleaned_deals}",
-            },
-        ]
-        response = openai_client.chat.completions.create(
-            model="gpt-5",
-            messages=messages,
-            max_tokens=2500,
-            n=1,
-            stop=None,
-            temperature=0.5,
+        return hubspot.run(
+            compile_deals(async_openai_client, cleaned_deals, limiter=realtime_limiter)
         )
-        return response.choices[0].message.content
     except Exception as e:
         print(f"Error: {e}")
         return None
 
 
 def add_field_to_deal(field):
-    url = "https://api.hubapi.com/properties/v1/deals/properties"
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-    }
+    url = "/properties/v1/deals/properties"
 
     label = field
     name = field.replace(" ", "_").lower()
@@ -751,7 +1238,7 @@ def add_field_to_deal(field):
         "fieldType": "text",
     }
 
-    response = requests.post(url, json=payload, headers=headers)
+    response = hubspot.post(url, json=payload)
 
     if response.status_code == 201:
         print("Custom property created successfully!")
@@ -760,11 +1247,7 @@ def add_field_to_deal(field):
 
 
 def update_deal(deal):
-    update_url = f"https://api.hubapi.com/deals/v1/deal/{deal.id}"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    update_url = f"/deals/v1/deal/{deal.id}"
 
     update_payload = {
         "properties": [
@@ -773,7 +1256,7 @@ def update_deal(deal):
         ]
     }
 
-    response = requests.put(update_url, json=update_payload, headers=headers)
+    response = hubspot.put(update_url, json=update_payload)
 
     if response.status_code == 200:
         print("Deal updated successfully!")
@@ -785,183 +1268,403 @@ def create_hubspot_field():
     pass
 
 
+# deals/batch/update accepts up to 100 inputs per call
+DEAL_UPDATE_BATCH_SIZE = 100
+DEAL_UPDATE_NETWORK_RETRIES = 2
+
+
+def canonical_keywords(value):
+    """
+    Canonical "a; b; c" form of a keyword list. Accepts a list, a Python list
+    repr (what older runs wrote), a JSON array, or a ";"-separated string.
+    """
+    if value is None:
+        return ""
+    items = value
+    if isinstance(value, str):
+        text = value.strip()
+        items = [text]
+        if text[:1] in ("[", "("):
+            try:
+                items = ast.literal_eval(text)
+            except (ValueError, SyntaxError):
+                try:
+                    items = json.loads(text)
+                except ValueError:
+                    pass
+        elif ";" in text:
+            items = text.split(";")
+    if not isinstance(items, (list, tuple)):
+        items = [items]
+    return "; ".join(str(item).strip() for item in items if str(item).strip())
+
+
+# Per-property canonical forms used to detect no-op writes
+PROPERTY_CANONICALIZERS = {"keywords": canonical_keywords}
+
+
+def canonical_property(name, value):
+    canonicalize = PROPERTY_CANONICALIZERS.get(name)
+    if canonicalize:
+        return canonicalize(value)
+    return "" if value is None else str(value).strip()
+
+
+def drop_unchanged(inputs, current):
+    """
+    Remove properties already at their target value, given the fetched
+    ``current`` properties by deal ID. Returns (inputs still to write,
+    IDs of deals whose update was a no-op).
+    """
+    changed, skipped = [], []
+    for item in inputs:
+        existing = current.get(item["id"])
+        if existing is None:
+            changed.append(item)
+            continue
+        properties = {
+            name: value
+            for name, value in item["properties"].items()
+            if canonical_property(name, value) != canonical_property(name, existing.get(name))
+        }
+        if properties:
+            changed.append({**item, "properties": properties})
+        else:
+            skipped.append(item["id"])
+    return changed, skipped
+
+
+def keywords_update(deal):
+    """The batch-update input writing a deal's recommendation to keywords, or None."""
+    if deal.get("parsed") and deal["parsed"].get("recommendation"):
+        rec_keys = canonical_keywords(deal["parsed"]["recommendation"])
+        return {"id": str(deal["id"]), "properties": {"keywords": rec_keys}}
+    return None
+
+
+async def update_deals_batch(inputs):
+    """
+    One deals/batch/update call for up to 100 inputs; returns
+    {deal_id: None on success, else the error message}.
+
+    429/5xx are retried by the client. A batch rejected as invalid (400)
+    is split in half and retried, so one bad record only fails itself;
+    any other error (auth, scopes, exhausted retries) fails the whole batch.
+    """
+    for attempt in range(DEAL_UPDATE_NETWORK_RETRIES + 1):
+        try:
+            async with hubspot.request_async(
+                "POST", "/crm/v3/objects/deals/batch/update", json={"inputs": inputs}
+            ) as response:
+                status = response.status
+                if status in (200, 207):
+                    data = await response.json()
+                else:
+                    text = await response.text()
+            break
+        except Exception as e:
+            if attempt == DEAL_UPDATE_NETWORK_RETRIES:
+                return {item["id"]: f"Request failed: {e}" for item in inputs}
+            await asyncio.sleep(2 ** attempt)
+
+    if status in (200, 207):
+        outcomes = {str(result["id"]): None for result in data.get("results", [])}
+        for error in data.get("errors", []):
+            for deal_id in (error.get("context") or {}).get("ids", []):
+                outcomes[str(deal_id)] = error.get("message") or error.get("category")
+        for item in inputs:
+            outcomes.setdefault(item["id"], "No result returned")
+        return outcomes
+
+    if status != 400 or len(inputs) == 1:
+        return {item["id"]: f"{status}: {text}" for item in inputs}
+    middle = len(inputs) // 2
+    halves = await asyncio.gather(
+        update_deals_batch(inputs[:middle]), update_deals_batch(inputs[middle:])
+    )
+    return {**halves[0], **halves[1]}
+
+
+async def update_deals_async(inputs):
+    """All inputs in concurrent batches of 100, paced by the HubSpot rate governor."""
+    batches = await asyncio.gather(
+        *[
+            update_deals_batch(batch)
+            for batch in chunked(list(inputs), DEAL_UPDATE_BATCH_SIZE)
+        ]
+    )
+    outcomes = {}
+    for batch in batches:
+        outcomes.update(batch)
+    return outcomes
+
+
+def update_deals(inputs, current=None):
+    """
+    Batch-update deals, skipping no-op writes when the fetched ``current``
+    properties are given. Returns ({deal_id: None on success, else the
+    error message}, [IDs skipped as unchanged]).
+    """
+    skipped = []
+    if current:
+        inputs, skipped = drop_unchanged(inputs, current)
+        if skipped:
+            logging.info(f"Skipping {len(skipped)} unchanged deal updates")
+    if not inputs:
+        return {}, skipped
+    outcomes = hubspot.run(update_deals_async(inputs))
+    failed = {deal_id: error for deal_id, error in outcomes.items() if error}
+    if failed:
+        logging.warning(f"{len(failed)} of {len(outcomes)} deal updates failed: {failed}")
+    return outcomes, skipped
+
+
+def update_hubspot_keywords_batch(deals):
+    """
+    Write every parsed deal's recommendation unless keywords already match.
+    Deals without a recommendation count as skipped, like unchanged ones.
+    """
+    current = {str(deal["id"]): deal.get("properties") or {} for deal in deals}
+    inputs, skipped = [], []
+    for deal in deals:
+        item = keywords_update(deal)
+        if item:
+            inputs.append(item)
+        else:
+            skipped.append(str(deal["id"]))
+    outcomes, unchanged = update_deals(inputs, current=current)
+    return outcomes, skipped + unchanged
+
+
 def update_hubspot_keywords(deal):
-    update_url = f"https://api.hubapi.com/deals/v1/deal/{deal['id']}"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    if deal.get("parsed"):
-        if deal["parsed"].get("recommendation"):
-            rec_keys = str(deal["parsed"]["recommendation"])
-            update_payload = {"properties": [{"name": "keywords", "value": rec_keys}]}
-            response = requests.put(update_url, json=update_payload, headers=headers)
-            return response
+    outcomes, _ = update_hubspot_keywords_batch([deal])
+    return outcomes.get(str(deal["id"]))
 
 
-def get_stage_mapping():
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    pipeline_url = f"https://api.hubapi.com/crm-pipelines/v1/pipelines/deals/default"
-    pipeline_response = requests.get(pipeline_url, headers=headers)
-    pipeline_data = pipeline_response.json()
+def get_pipeline(pipeline_id="default"):
+    return get_hubspot_metadata(f"/crm-pipelines/v1/pipelines/deals/{pipeline_id}")
+
+
+def get_stage_mapping(pipeline_id="default"):
+    pipeline_data = get_pipeline(pipeline_id)
     # Create a mapping of stage IDs to stage labels
     stage_mapping = {
         stage["stageId"]: stage["label"] for stage in pipeline_data["stages"]
     }
-    # Store the mapping in the dictionary with the deal ID as the key
     return stage_mapping
 
 
 def get_deal_stage_name(stage_id, pipeline_id):
-    # Fetch the pipeline data using the pipeline ID
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    pipeline_url = (
-        f"https://api.hubapi.com/crm-pipelines/v1/pipelines/deals/{pipeline_id}"
-    )
-    pipeline_response = requests.get(pipeline_url, headers=headers)
-    if pipeline_response.status_code != 200:
-        raise Exception(
-            f"Failed to fetch pipeline data: {pipeline_response.status_code} {pipeline_response.text}"
-        )
-    pipeline_data = pipeline_response.json()
-    # Search for the stage with the matching ID
-    for stage in pipeline_data["stages"]:
-        if stage["stageId"] == stage_id:
-            return stage["label"]
+    return get_stage_mapping(pipeline_id).get(stage_id)
 
 
 def get_deal_stage_history(deals):
-    stage_mapping = get_stage_mapping()
-    for deal in deals:
-        time.sleep(0.1)
-        deal_id = deal["id"]
-        # Define the API endpoint and parameters
-        url = f"https://api.hubapi.com/crm/v3/objects/deals/{deal_id}"
-        headers = {
-            "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        params = {
-            "propertiesWithHistory": "dealstage",
-        }
-        # Make the request to HubSpot API
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            deal_stage_history = response.json()["propertiesWithHistory"]["dealstage"]
-            for stage in deal_stage_history:
-                stage_id = stage["value"]
-                if stage_mapping.get(stage_id):
-                    stage_name = stage_mapping[stage_id]
-                    stage["stage_name"] = stage_name
-                else:
-                    stage.pop(stage_id, None)
-            deal["deal_stage_history"] = deal_stage_history
-        else:
-            print(
-                f"Failed to retrieve deal data: {response.status_code} {response.text}"
-            )
+    attach_stage_histories(deals)
     return deals
 
 
-async def fetch_notes_attachments_and_engagements(
-    deals, batch_size=4, delay_between_batches=1.2
-):
-    sslcontext = ssl.create_default_context(cafile=certifi.where())
-
-    async with aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(ssl=sslcontext)
-    ) as session:
-        for i in range(0, len(deals), batch_size):
-            batch = deals[i : i + batch_size]
-            tasks = [fetch_data_for_deal(session, deal["id"]) for deal in batch]
-            results = await asyncio.gather(*tasks)
+def attach_notes_attachments_and_engagements(deals):
+    """Notes/attachments/engagements, re-fetched only for deals modified since last enrichment."""
+    return enrich_from_store(
+        deals,
+        "notes_attachments_engagements",
+        ["notes", "attachments", "engagements"],
+        lambda stale: hubspot.run(fetch_notes_attachments_and_engagements(stale)),
+    )
 
-            for deal, result in zip(batch, results):
-                deal["notes"] = result.get("notes")
-                deal["attachments"] = result.get("attachments")
-                deal["engagements"] = result.get("engagements")
 
-            await asyncio.sleep(delay_between_batches)
-        return deals
+def is_transient_fetch_error(error):
+    """Worth retrying on the next run, unlike e.g. a 404 or an unsupported file."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
 
 
-async def fetch_data_for_deal(session, deal_id):
-    notes_task = fetch_notes(session, deal_id)
-    engagements_task = fetch_engagements(session, deal_id)
+async def fetch_notes_attachments_and_engagements(deals):
+    """Attach notes, attachments and engagements; returns the IDs with fetch errors."""
+    # Notes for every deal come from a handful of batch calls up front
+    notes_by_deal = await fetch_notes_for_deals([deal["id"] for deal in deals])
 
-    notes_result, engagements_result = await asyncio.gather(
-        notes_task, engagements_task
+    # All deals are scheduled at once; the HubSpot client's rate governor
+    # keeps requests flowing at the account's limit instead of fixed batches
+    results = await asyncio.gather(
+        *[
+            fetch_data_for_deal(deal["id"], notes_by_deal.get(deal["id"]) or [])
+            for deal in deals
+        ]
     )
 
-    notes, attachments = await process_notes_for_attachments(
-        session, notes_result["results"]
-    )
+    failed = set()
+    for deal, result in zip(deals, results):
+        deal["notes"] = result.get("notes")
+        deal["attachments"] = result.get("attachments")
+        deal["engagements"] = result.get("engagements")
+        if not result["complete"] or notes_by_deal.get(deal["id"]) is None:
+            failed.add(deal["id"])
+    return failed
+
+
+async def fetch_data_for_deal(deal_id, notes=None):
+    """
+    Notes, attachments and engagements for one deal. Failed parts come back
+    empty with ``complete`` False.
+    """
+
+    async def engagements():
+        try:
+            return await fetch_engagements(deal_id), True
+        except Exception as e:
+            if not is_transient_fetch_error(e):
+                raise
+            print(f"Failed to fetch engagements for deal {deal_id}: {e}")
+            return [], False
+
+    if notes is None:
+        notes_result, (engagements_result, complete) = await asyncio.gather(
+            fetch_notes(deal_id), engagements()
+        )
+        notes = notes_result["results"] if notes_result else []
+    else:
+        engagements_result, complete = await engagements()
+
+    notes, attachments, attachments_complete = await process_notes_for_attachments(notes)
 
     return {
         "notes": notes,
         "attachments": attachments,
         "engagements": engagements_result,
+        "complete": complete and attachments_complete,
     }
 
 
-async def fetch_notes(session, deal_id):
-    url = "https://api.hubapi.com/crm/v3/objects/notes/search"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
+# Batch association and batch read endpoints accept up to 100 IDs per request
+NOTES_BATCH_SIZE = 100
+NOTE_PROPERTIES = ["hs_note_body", "hs_attachment_ids"]
+
+
+def chunked(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+async def fetch_note_associations_batch(deal_ids):
+    """Map each deal ID to its associated note IDs with one v4 batch call."""
+    body = {"inputs": [{"id": deal_id} for deal_id in deal_ids]}
+    async with hubspot.request_async(
+        "POST", "/crm/v4/associations/deals/notes/batch/read", json=body
+    ) as response:
+        # 207 means some deals had no associations or failed; the rest are in "results"
+        if response.status not in (200, 207):
+            print(
+                f"Failed to retrieve note associations: {response.status} {await response.text()}"
+            )
+            return None
+        data = await response.json()
+
+    associations = {}
+    for result in data.get("results", []):
+        deal_id = str(result["from"]["id"])
+        note_ids = [str(to["toObjectId"]) for to in result.get("to", [])]
+        after = result.get("paging", {}).get("next", {}).get("after")
+        # Deals with more notes than fit in one page are followed up individually
+        while after:
+            async with hubspot.request_async(
+                "GET",
+                f"/crm/v4/objects/deals/{deal_id}/associations/notes",
+                params={"after": after, "limit": 500},
+            ) as response:
+                response.raise_for_status()
+                page = await response.json()
+            note_ids.extend(str(to["toObjectId"]) for to in page.get("results", []))
+            after = page.get("paging", {}).get("next", {}).get("after")
+        associations[deal_id] = note_ids
+    return associations
+
+
+async def fetch_notes_batch(note_ids):
+    """Read note bodies and attachment IDs for up to 100 notes; None if the read failed."""
+    body = {
+        "inputs": [{"id": note_id} for note_id in note_ids],
+        "properties": NOTE_PROPERTIES,
     }
-    search_body = {
-        "filterGroups": [
-            {
-                "filters": [
-                    {
-                        "propertyName": "associations.deal",
-                        "operator": "EQ",
-                        "value": deal_id,
-                    }
-                ]
-            }
-        ],
-        "properties": ["hs_note_body", "hs_attachment_ids", "propertyName"],
+    async with hubspot.request_async(
+        "POST", "/crm/v3/objects/notes/batch/read", json=body
+    ) as response:
+        if response.status not in (200, 207):
+            print(
+                f"Failed to retrieve notes: {response.status} {await response.text()}"
+            )
+            return None
+        data = await response.json()
+    return {note["id"]: note for note in data.get("results", [])}
+
+
+async def fetch_notes_for_deals(deal_ids):
+    """
+    Bulk notes loader: deal -> note associations in batches of 100, then note
+    bodies via batch read. Returns {deal_id: [note, ...]} in the same shape as
+    the per-deal notes search results; deals whose notes couldn't all be
+    read map to None.
+    """
+    deal_batches = chunked(list(deal_ids), NOTES_BATCH_SIZE)
+    association_results = await asyncio.gather(
+        *[fetch_note_associations_batch(batch) for batch in deal_batches]
+    )
+    associations, failed_deals = {}, set()
+    for batch, result in zip(deal_batches, association_results):
+        if result is None:
+            failed_deals.update(str(deal_id) for deal_id in batch)
+        else:
+            associations.update(result)
+
+    # A note can be attached to several deals; read each one once
+    unique_note_ids = list(
+        dict.fromkeys(
+            note_id for note_ids in associations.values() for note_id in note_ids
+        )
+    )
+    note_batches = chunked(unique_note_ids, NOTES_BATCH_SIZE)
+    note_results = await asyncio.gather(
+        *[fetch_notes_batch(batch) for batch in note_batches]
+    )
+    notes, failed_notes = {}, set()
+    for batch, result in zip(note_batches, note_results):
+        if result is None:
+            failed_notes.update(batch)
+        else:
+            notes.update(result)
+
+    return {
+        deal_id: None
+        if str(deal_id) in failed_deals
+        or failed_notes.intersection(associations.get(str(deal_id), []))
+        else [
+            notes[note_id]
+            for note_id in associations.get(str(deal_id), [])
+            if note_id in notes
+        ]
+        for deal_id in deal_ids
     }
 
-    max_retries = 5
-    backoff_time = 2
-    for attempt in range(max_retries):
-        async with session.post(url, headers=headers, json=search_body) as response:
-            if response.status == 200:
-                return await response.json()
-            elif response.status == 429:  # Rate limit error
-                print(
-                    f"Rate limit hit: waiting {backoff_time} seconds before retrying..."
-                )
-                await asyncio.sleep(backoff_time)
-                backoff_time *= 2  # Exponentially increase backoff time
-            else:
-                print(
-                    f"Failed to retrieve deal data: {response.status} {await response.text()}"
-                )
-                return None
 
-    print(f"Max retries reached for deal {deal_id}.")
-    return None
+async def fetch_notes(deal_id):
+    notes = await fetch_notes_for_deals([deal_id])
+    return {"results": notes.get(deal_id) or []}
 
 
-async def process_notes_for_attachments(session, notes):
+async def process_notes_for_attachments(notes):
+    """
+    Fetch the notes' attachments. Returns (notes, attachments, complete),
+    where ``complete`` is False if any attachment hit a transient error.
+    """
     attachments = []
     tasks = []
     note_indices = []
+    complete = True
 
     for note_idx, note in enumerate(notes):
         if note["properties"].get("hs_attachment_ids"):
             file_id = note["properties"]["hs_attachment_ids"]
-            tasks.append(fetch_attachment(session, file_id))
+            tasks.append(fetch_attachment(file_id))
             note_indices.append(note_idx)
 
     if tasks:
@@ -970,52 +1673,131 @@ async def process_notes_for_attachments(session, notes):
         for note_idx, result in zip(note_indices, results):
             if isinstance(result, Exception):
                 print(f"Failed to fetch attachment for note index {note_idx}: {result}")
+                if is_transient_fetch_error(result):
+                    complete = False
             else:
                 attachments.append(result)
 
-    return notes, attachments
+    return notes, attachments, complete
 
 
-async def fetch_attachment(session, file_id):
-    url = f"https://api.hubapi.com/filemanager/api/v3/files/{file_id}/signed-url"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-        "User-Agent": "Custom",
-    }
-    async with session.get(url, headers=headers) as response:
+# File ID -> {sha256, size, extension, name}, and sha256 -> extracted content.
+# HubSpot files rarely change, so a file is only re-checked after the TTL, and
+# identical bytes behind different file IDs are parsed once.
+attachment_files = TTLCache("attachment_files")
+attachment_extractions = TTLCache("attachment_extractions")
+ATTACHMENT_CACHE_TTL = 30 * 24 * 60 * 60
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# In-flight fetches by file ID, so notes sharing a file download it once per run
+_attachment_tasks = {}
+
+
+def extraction_key(content_hash):
+    return f"v{EXTRACTION_VERSION}:{content_hash}"
+
+
+def cached_extraction(content_hash):
+    found = attachment_extractions.entry(extraction_key(content_hash))
+    return found[0] if found else None
+
+
+async def fetch_attachment(file_id):
+    file_id = str(file_id)
+    task = _attachment_tasks.get(file_id)
+    if task is None:
+        task = asyncio.ensure_future(fetch_attachment_uncached(file_id))
+        _attachment_tasks[file_id] = task
+        task.add_done_callback(lambda _: _attachment_tasks.pop(file_id, None))
+    # Shielded so one cancelled caller doesn't cancel the fetch for the others
+    return await asyncio.shield(task)
+
+
+async def fetch_attachment_uncached(file_id):
+    found = attachment_files.entry(file_id)
+    known = found[0] if found else None
+    if known and (found[1] is None or found[1] > time.time()):
+        extracted = cached_extraction(known["sha256"])
+        if extracted is not None:
+            return extracted
+
+    url = f"/filemanager/api/v3/files/{file_id}/signed-url"
+    headers = {"User-Agent": "Custom"}
+    async with hubspot.request_async("GET", url, headers=headers) as response:
         response.raise_for_status()
         data = await response.json()
-        file_url = data["url"]
-        extension = data["extension"]
-        name = data["name"]
-
-        async with session.get(file_url) as file_response:
-            file_content = await file_response.read()
-
-        if extension == "pdf":
-            return read_pdf(file_content)
-        elif extension == "docx":
-            return read_word(file_content)
-        elif extension == "xlsx":
-            return read_excel(file_content)
-        elif extension == "pptx":
-            return read_ppt(file_content)
+    file_url = data["url"]
+    extension = data.get("extension")
+    name = data["name"]
+    size = data.get("size")
+
+    # Expired entry for a file that still looks the same: skip the download
+    if (
+        known
+        and size is not None
+        and known.get("size") == size
+        and known.get("extension") == extension
+    ):
+        extracted = cached_extraction(known["sha256"])
+        if extracted is not None:
+            attachment_files.touch(file_id, ATTACHMENT_CACHE_TTL)
+            attachment_extractions.touch(
+                extraction_key(known["sha256"]), ATTACHMENT_CACHE_TTL
+            )
+            return extracted
+
+    # Reject unsupported or oversized files before downloading anything; a
+    # file without an extension is judged by its Content-Type instead
+    if extension and not is_supported(extension):
+        raise ValueError(f"Unsupported file type: {extension} for {name}")
+    check_size(size, name)
+
+    with SpooledDownload(name=name) as download:
+        async with hubspot.request_async("GET", file_url) as file_response:
+            file_response.raise_for_status()
+            mime_type = file_response.content_type
+            if not is_supported(extension, mime_type):
+                raise ValueError(
+                    f"Unsupported file type: {extension or mime_type} for {name}"
+                )
+            check_size(file_response.content_length, name)
+            async for chunk in file_response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                download.write(chunk)
+
+        content_hash = download.hexdigest()
+        extracted = cached_extraction(content_hash)
+        if extracted is None:
+            # Parsing runs in the extraction pool so it doesn't stall the event loop
+            extracted = await extraction_pool.extract(
+                extension, download.source(), name=name, mime_type=mime_type
+            )
+            attachment_extractions.set(
+                extraction_key(content_hash), extracted, ttl=ATTACHMENT_CACHE_TTL
+            )
         else:
-            raise ValueError(f"Unsupported file type: {extension} for {name}")
+            attachment_extractions.touch(
+                extraction_key(content_hash), ATTACHMENT_CACHE_TTL
+            )
+    attachment_files.set(
+        file_id,
+        {
+            "sha256": content_hash,
+            "size": size if size is not None else download.size,
+            "extension": extension,
+            "name": name,
+        },
+        ttl=ATTACHMENT_CACHE_TTL,
+    )
+    return extracted
 
 
-async def fetch_engagements(session, deal_id, engagement_type="EMAIL"):
-    url = f"https://api.hubapi.com/engagements/v1/engagements/associated/deal/{deal_id}/paged"
-    headers = {
-        "Authorization": f"Bearer {HUBSPOT_API_KEY}",
-        "Content-Type": "application/json",
-    }
+async def fetch_engagements(deal_id, engagement_type="EMAIL"):
+    url = f"/engagements/v1/engagements/associated/deal/{deal_id}/paged"
     params = {"limit": 100, "offset": 0}
     engagements = []
 
     while True:
-        async with session.get(url, headers=headers, params=params) as response:
+        async with hubspot.request_async("GET", url, params=params) as response:
             response.raise_for_status()
             data = await response.json()
             engagements.extend(
@@ -1032,135 +1814,239 @@ async def fetch_engagements(session, deal_id, engagement_type="EMAIL"):
     return engagements
 
 
-def export_csv(start_date=None, end_date=None):
-    """Export deals data to CSV with improved error handling and performance."""
-    logging.info(f"Starting CSV export for dates: {start_date} to {end_date}")
+STAGE_ENTERED_PREFIX = "hs_date_entered_"
+STAGE_EXITED_PREFIX = "hs_date_exited_"
+STAGE_SOURCES = ("properties", "history")
+
+
+def stage_date_properties(stage_mapping):
+    """hs_date_entered_/hs_date_exited_ property names for every stage in the pipeline."""
+    properties = []
+    for stage_id in stage_mapping:
+        properties.append(f"{STAGE_ENTERED_PREFIX}{stage_id}")
+        properties.append(f"{STAGE_EXITED_PREFIX}{stage_id}")
+    return properties
+
+
+# Columns dropped from the CSV export (only if they exist)
+EXPORT_EXCLUDED_COLUMNS = [
+    "hs_object_id",
+    "archived",
+    "hs_lastmodifieddate",
+    "hubspot_owner_id",
+    "pipeline",
+    "team_member_1",
+    "id",
+    "createdAt",
+    "updatedAt",
+    "Lead Owner Email",
+    "Support Member Email",
+]
+
+
+def validate_stage_source(stage_source):
+    if stage_source not in STAGE_SOURCES:
+        raise ValueError(
+            f"stage_source must be one of {', '.join(STAGE_SOURCES)}, got {stage_source}"
+        )
 
-    # Fetch deals with all enriched data
-    deals = fetch_deals_and_stage_histories(start_date, end_date)
-    logging.info(f"Fetched {len(deals)} deals")
 
-    # Fetch and process fund mapping
-    fund_mapping = {}
+def fetch_fund_mapping():
     try:
-        fetched_deal_properties = fetch_deal_properties()
-        for prop in fetched_deal_properties:
-            if prop.get("name") == "fund" and "options" in prop:
-                for option in prop["options"]:
-                    fund_mapping[option.get("value")] = option.get(
-                        "label", option.get("value")
-                    )
+        return get_property_option_labels("fund")
     except Exception as e:
         logging.warning(f"Could not fetch fund mapping: {e}")
+        return {}
 
-    flattened_data = []
-    for deal in deals:
-        # Start with properties but avoid full copy for memory efficiency
-        flattened_entry = {}
-        flattened_entry.update(deal.get("properties", {}))
-        flattened_entry["id"] = deal.get("id")
-        flattened_entry["createdAt"] = deal.get("createdAt")
-        flattened_entry["updatedAt"] = deal.get("updatedAt")
-        flattened_entry["archived"] = deal.get("archived", False)
-
-        # Safe fund mapping with fallback
-        if "fund" in flattened_entry and flattened_entry["fund"]:
-            flattened_entry["fund"] = fund_mapping.get(
-                flattened_entry["fund"],
-                flattened_entry["fund"],  # Keep original if not in mapping
-            )
-        # Safe extraction of Lead Owner details
-        if deal.get("hubspot_owner_id_details"):
-            lead_owner = deal.get("hubspot_owner_id_details")
-            first_name = lead_owner.get("firstName", "")
-            last_name = lead_owner.get("lastName", "")
-            flattened_entry["Lead Owner Name"] = f"{first_name} {last_name}".strip()
-            flattened_entry["Lead Owner Email"] = lead_owner.get("email", "")
-        else:
-            flattened_entry["Lead Owner Name"] = ""
-            flattened_entry["Lead Owner Email"] = ""
-
-        # Safe extraction of Support Member details
-        if deal.get("team_member_1_details"):
-            support_member = deal.get("team_member_1_details")
-            first_name = support_member.get("firstName", "")
-            last_name = support_member.get("lastName", "")
-            flattened_entry["Support Member Name"] = f"{first_name} {last_name}".strip()
-            flattened_entry["Support Member Email"] = support_member.get("email", "")
+
+def export_filename(start_date=None, end_date=None):
+    if start_date is None and end_date is None:
+        start_date = str(datetime.now().date() + relativedelta(months=-3))
+        end_date = str(datetime.now().date() + relativedelta(days=+1))
+    start_date = str(datetime.strptime(start_date, "%Y-%m-%d").date())
+    end_date = str(datetime.strptime(end_date, "%Y-%m-%d").date())
+    return f"Deal_Export--{start_date}-{end_date}.csv"
+
+
+def stage_durations_frame_from_history(deals, now=None):
+    """
+    Days spent in each stage from the full dealstage history, summing re-entries.
+
+    Explodes every stage history into one long table, parses timestamps in
+    one pass, takes each stage's exit as the next entry within the deal (or
+    now for the current stage), and pivots summed days per stage name.
+    """
+    now = pd.Timestamp(now or datetime.now(timezone.utc))
+    history = pd.DataFrame.from_records(
+        [
+            (deal.get("id"), stage.get("stage_name", "Unknown Stage"), stage.get("timestamp"))
+            for deal in deals
+            for stage in deal.get("deal_stage_history") or []
+        ],
+        columns=["id", "stage_name", "timestamp"],
+    )
+    if history.empty:
+        return pd.DataFrame(index=pd.Index([], name="id"))
+
+    history["entered"] = pd.to_datetime(
+        history["timestamp"], utc=True, errors="coerce", format="ISO8601"
+    )
+    history = history.sort_values(["id", "entered"], kind="stable")
+    history["exited"] = history.groupby("id", sort=False)["entered"].shift(-1)
+    history["exited"] = history["exited"].fillna(now)
+    history["days"] = (history["exited"] - history["entered"]).dt.days
+    history = history.dropna(subset=["days"])
+    durations = history.pivot_table(
+        index="id", columns="stage_name", values="days", aggfunc="sum", sort=False
+    )
+    durations.columns = [f"{stage_name}_days_in_stage" for stage_name in durations.columns]
+    return durations
+
+
+def stage_durations_frame_from_properties(properties, stage_mapping, now=None):
+    """
+    Days spent in each stage from the hs_date_entered_/hs_date_exited_ columns.
+
+    These properties only record the most recent visit to a stage, so a
+    re-entered stage counts its last stay only; use the history path when
+    that matters.
+    """
+    now = pd.Timestamp(now or datetime.now(timezone.utc))
+    durations = pd.DataFrame(index=properties.index)
+    for stage_id, stage_name in stage_mapping.items():
+        entered_column = f"{STAGE_ENTERED_PREFIX}{stage_id}"
+        if entered_column not in properties:
+            continue
+        entered = pd.to_datetime(
+            properties[entered_column], utc=True, errors="coerce", format="ISO8601"
+        )
+        exited = pd.to_datetime(
+            properties.get(
+                f"{STAGE_EXITED_PREFIX}{stage_id}", pd.Series(None, index=properties.index)
+            ),
+            utc=True,
+            errors="coerce",
+            format="ISO8601",
+        )
+        # No exit, or an exit older than the latest entry, means the deal is still there
+        exited = exited.where(exited.notna() & (exited >= entered), now)
+        days = (exited - entered).dt.days
+        column = f"{stage_name}_days_in_stage"
+        if column in durations:
+            durations[column] = durations[column].add(days, fill_value=0)
         else:
-            flattened_entry["Support Member Name"] = ""
-            flattened_entry["Support Member Email"] = ""
-        # Calculate time spent in each stage
-        stage_durations = {}
-        if "deal_stage_history" in deal and deal["deal_stage_history"]:
-            stages = deal["deal_stage_history"]
-            stages.sort(key=lambda x: x.get("timestamp", 0))  # Sort by timestamp
-
-            # Process transitions between stages
-            for i in range(len(stages) - 1):
-                stage_name = stages[i].get("stage_name", "Unknown Stage")
-                entry_timestamp = stages[i].get("timestamp")
-                exit_timestamp = stages[i + 1].get("timestamp")
+            durations[column] = days
+    return durations.dropna(axis=1, how="all")
 
-                try:
-                    entry_time = parser.parse(entry_timestamp)
-                    exit_time = parser.parse(exit_timestamp)
-                    duration = (exit_time - entry_time).days
-                    stage_durations[stage_name] = (
-                        stage_durations.get(stage_name, 0) + duration
-                    )
-                except Exception as e:
-                    logging.warning(
-                        f"Error parsing timestamps for deal {deal.get('id')}: {e}"
-                    )
-
-            # Handle the last stage (current stage) - calculated ONCE outside the loop
-            if stages:
-                last_stage = stages[-1]
-                last_stage_name = last_stage.get("stage_name", "Unknown Stage")
-                last_entry_timestamp = last_stage.get("timestamp")
 
-                try:
-                    last_entry_time = parser.parse(last_entry_timestamp)
-                    last_exit_time = datetime.now(timezone.utc)
-                    last_duration = (last_exit_time - last_entry_time).days
-                    stage_durations[last_stage_name] = (
-                        stage_durations.get(last_stage_name, 0) + last_duration
-                    )
-                except Exception as e:
-                    logging.warning(
-                        f"Error parsing last stage timestamp for deal {deal.get('id')}: {e}"
-                    )
-        for stage_name, duration in stage_durations.items():
-            flattened_entry[f"{stage_name}_days_in_stage"] = duration
-        flattened_data.append(flattened_entry)
-        # Convert to DataFrame
-    df = pd.DataFrame(flattened_data)
-    # List of columns to exclude (only drop if they exist)
-    columns_to_exclude = [
-        "hs_object_id",
-        "archived",
-        "hs_lastmodifieddate",
-        "hubspot_owner_id",
-        "pipeline",
-        "team_member_1",
-        "id",
-        "createdAt",
-        "updatedAt",
-        "Lead Owner Email",
-        "Support Member Email",
+def owner_name_columns(frame, owner_property, prefix):
+    """Vectorized owner join: <prefix> Name/Email columns from the owner directory."""
+    if owner_property not in frame:
+        return pd.DataFrame(
+            {f"{prefix} Name": "", f"{prefix} Email": ""}, index=frame.index
+        )
+    owner_ids = frame[owner_property].astype("string")
+    owners = resolve_owners(owner_ids.dropna().unique())
+    names = pd.Series(
+        {
+            owner_id: f"{owner.get('firstName') or ''} {owner.get('lastName') or ''}".strip()
+            for owner_id, owner in owners.items()
+        },
+        dtype="object",
+    )
+    emails = pd.Series(
+        {owner_id: owner.get("email") or "" for owner_id, owner in owners.items()},
+        dtype="object",
+    )
+    return pd.DataFrame(
+        {
+            f"{prefix} Name": owner_ids.map(names).fillna("").astype(object),
+            f"{prefix} Email": owner_ids.map(emails).fillna("").astype(object),
+        },
+        index=frame.index,
+    )
+
+
+def build_export_frame(deals, fund_mapping, stage_source="properties", stage_mapping=None):
+    """
+    One export row per deal: properties without the stage date columns,
+    fund labels, owner names and *_days_in_stage durations, built column-wise.
+    """
+    frame = pd.DataFrame.from_records(
+        [deal.get("properties", {}) for deal in deals],
+        # An empty range still exports the property header
+        columns=None if deals else DEAL_PROPERTIES,
+    )
+    frame.index = pd.Index([deal.get("id") for deal in deals], name="id")
+    stage_date_columns = [
+        column
+        for column in frame.columns
+        if column.startswith((STAGE_ENTERED_PREFIX, STAGE_EXITED_PREFIX))
     ]
+    stage_dates = frame[stage_date_columns]
+    frame = frame.drop(columns=stage_date_columns)
+
+    frame["createdAt"] = [deal.get("createdAt") for deal in deals]
+    frame["updatedAt"] = [deal.get("updatedAt") for deal in deals]
+    frame["archived"] = [deal.get("archived", False) for deal in deals]
+
+    # Fund labels with fallback to the raw value
+    if "fund" in frame:
+        frame["fund"] = frame["fund"].map(fund_mapping).fillna(frame["fund"])
+
+    if stage_source == "history":
+        durations = stage_durations_frame_from_history(deals)
+    else:
+        durations = stage_durations_frame_from_properties(stage_dates, stage_mapping)
+
+    frame = pd.concat(
+        [
+            frame,
+            owner_name_columns(frame, "hubspot_owner_id", "Lead Owner"),
+            owner_name_columns(frame, "team_member_1", "Support Member"),
+        ],
+        axis=1,
+    ).join(durations)
+    return frame.reset_index()
+
+
+def export_csv(start_date=None, end_date=None, stage_source="properties"):
+    """
+    Export deals data to CSV with improved error handling and performance.
+
+    stage_source="properties" computes stage durations from the
+    hs_date_entered_/hs_date_exited_ properties pulled with the search pages;
+    stage_source="history" downloads full dealstage history so re-entered
+    stages are summed across visits.
+    """
+    logging.info(f"Starting CSV export for dates: {start_date} to {end_date}")
+    validate_stage_source(stage_source)
+
+    # Fetch deals with all enriched data
+    if stage_source == "history":
+        stage_mapping = None
+        deals = fetch_deals_and_stage_histories(start_date, end_date)
+    else:
+        stage_mapping = get_stage_mapping()
+        # Owner names are joined column-wise in build_export_frame
+        deals = fetch_deals(
+            start_date,
+            end_date,
+            extra_properties=stage_date_properties(stage_mapping),
+        )
+    logging.info(f"Fetched {len(deals)} deals")
+
+    # Fetch and process fund mapping
+    fund_mapping = fetch_fund_mapping()
+
+    # Flatten, join owners/funds and compute stage durations column-wise
+    df = build_export_frame(deals, fund_mapping, stage_source, stage_mapping)
     # Drop only columns that exist in the dataframe
-    columns_to_drop = [col for col in columns_to_exclude if col in df.columns]
+    columns_to_drop = [col for col in EXPORT_EXCLUDED_COLUMNS if col in df.columns]
     if columns_to_drop:
         df = df.drop(columns=columns_to_drop)
-    if start_date is None and end_date is None:
-        start_date = str(datetime.now().date() + relativedelta(months=-3))
-        end_date = str(datetime.now().date() + relativedelta(days=+1))
-    start_date = str(datetime.strptime(start_date, "%Y-%m-%d").date())
-    end_date = str(datetime.strptime(end_date, "%Y-%m-%d").date())
     # Generate filename with proper date handling
-    filename = f"Deal_Export--{start_date}-{end_date}.csv"
+    filename = export_filename(start_date, end_date)
 
     # Create CSV in memory
     file_object = io.StringIO()
@@ -1172,3 +2058,4 @@ def export_csv(start_date=None, end_date=None):
     logging.info(f"Filename: {filename}")
 
     return file_object, filename
+
@@ -0,0 +1,160 @@
+"""
+Concurrent real-time chat completions for small runs.
+
+Requests run concurrently under a semaphore and two token buckets,
+requests/minute and tokens/minute. The buckets start from OPENAI_RPM and
+OPENAI_TPM and then follow the ``x-ratelimit-*`` headers of each
+response; waiting requests re-check the buckets, so a raised (or
+lowered) limit applies to them too. 429s, timeouts and 5xx responses are
+retried with backoff.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import re
+
+import openai
+
+from hubspot_client import RATE_RECHECK_SECONDS, TokenBucket
+
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "30000"))
+REALTIME_CONCURRENCY = int(os.getenv("OPENAI_REALTIME_CONCURRENCY", "16"))
+REALTIME_MAX_RETRIES = 5
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value):
+    """Seconds in an OpenAI reset header such as "1s", "6m0s" or "20ms"."""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(str(value))
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _header_number(headers, name):
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class OpenAIRateLimiter:
+    """
+    Requests/minute and tokens/minute buckets shared by concurrent callers.
+
+    A request takes one request and its estimated tokens once both buckets
+    have room at their current rates. Limits and remaining budgets from
+    response headers replace the configured defaults, keeping ``headroom``
+    in reserve.
+    """
+
+    def __init__(self, rpm=OPENAI_RPM, tpm=OPENAI_TPM, headroom=0.9):
+        self.headroom = headroom
+        self.requests = TokenBucket(rpm * headroom / 60, capacity=rpm * headroom)
+        self.tokens = TokenBucket(tpm * headroom / 60, capacity=tpm * headroom)
+
+    async def acquire(self, tokens):
+        while True:
+            delay = max(self.requests.wait_time(), self.tokens.wait_time(tokens))
+            if not delay:
+                # No await between the check and the take, so no other caller interleaves
+                self.requests.take()
+                self.tokens.take(tokens)
+                return
+            await asyncio.sleep(min(delay, RATE_RECHECK_SECONDS))
+
+    def per_minute(self):
+        """Current (requests, tokens) per minute, after headroom."""
+        return self.requests.rate * 60, self.tokens.rate * 60
+
+    def observe(self, headers):
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = _header_number(headers, f"x-ratelimit-limit-{kind}")
+            if limit:
+                budget = limit * self.headroom
+                if abs(bucket.capacity - budget) > 1:
+                    # The per-minute allowance is there to use now, not just its refill rate
+                    bucket.resize(budget / 60, budget)
+            remaining = _header_number(headers, f"x-ratelimit-remaining-{kind}")
+            reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+            if (
+                remaining is not None
+                and reset
+                and remaining < bucket.capacity * (1 - self.headroom)
+            ):
+                bucket.pause(reset)
+
+    def retry_delay(self, attempt, headers=None):
+        headers = headers or {}
+        retry_after = _header_number(headers, "retry-after")
+        if retry_after is not None:
+            return retry_after
+        resets = [
+            parse_reset(headers.get("x-ratelimit-reset-requests")),
+            parse_reset(headers.get("x-ratelimit-reset-tokens")),
+        ]
+        resets = [reset for reset in resets if reset]
+        if resets:
+            return max(resets)
+        return min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+async def complete(client, limiter, request, tokens):
+    """One chat completion with rate limiting and retries; returns the message content."""
+    for attempt in range(REALTIME_MAX_RETRIES + 1):
+        await limiter.acquire(tokens)
+        try:
+            raw = await client.chat.completions.with_raw_response.create(**request)
+        except RETRYABLE_ERRORS as error:
+            if attempt == REALTIME_MAX_RETRIES:
+                raise
+            response = getattr(error, "response", None)
+            headers = response.headers if response is not None else {}
+            if response is not None:
+                limiter.observe(headers)
+            delay = limiter.retry_delay(attempt, headers)
+            logging.info(f"OpenAI request failed ({error}); retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        limiter.observe(raw.headers)
+        return raw.parse().choices[0].message.content
+
+
+async def complete_all(client, requests, concurrency=REALTIME_CONCURRENCY, limiter=None):
+    """
+    Run ``{key: (request, estimated_tokens)}`` concurrently.
+
+    Returns ``{key: content}``; a request that still fails after retries
+    maps to its exception instead.
+    """
+    limiter = limiter or OpenAIRateLimiter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(key, request, tokens):
+        async with semaphore:
+            try:
+                return key, await complete(client, limiter, request, tokens)
+            except Exception as error:
+                return key, error
+
+    results = await asyncio.gather(
+        *[run(key, request, tokens) for key, (request, tokens) in requests.items()]
+    )
+    return dict(results)
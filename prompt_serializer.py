@@ -0,0 +1,202 @@
+"""
+Compact deal serialization for GPT prompts.
+
+Instead of the repr of the whole enriched deal, prompts get only the fields
+the gpt_prompt.txt schema asks for plus cleaned free text (notes, emails,
+attachments). HTML and quoted email replies are stripped, repeated
+lines are dropped, and the text is cut to a per-deal token budget in
+priority order.
+"""
+
+import html
+import json
+import os
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# Per-deal token budget for the serialized deal, and the most any single
+# note/email/attachment may take of it
+DEAL_PROMPT_TOKEN_BUDGET = int(os.getenv("DEAL_PROMPT_TOKEN_BUDGET", "2000"))
+DEAL_PROMPT_ITEM_TOKENS = int(os.getenv("DEAL_PROMPT_ITEM_TOKENS", "600"))
+CHARS_PER_TOKEN = 4
+
+# Deal properties the prompt schema reads, in output order
+PROMPT_PROPERTIES = [
+    "dealname",
+    "broad_category_updated",
+    "subcategory",
+    "fund",
+    "createdate",
+    "priority",
+    "referral_type",
+]
+# Free-text sections, highest priority first; later sections get what's left
+PROMPT_SECTIONS = ["notes", "emails", "attachments"]
+
+# Reply history starts at these lines. Forwarded-message headers (From:,
+# "Forwarded message", "Begin forwarded message:") are content and stay
+_REPLY_MARKERS = re.compile(r"^(On .+ wrote:|-+ ?Original Message ?-+)$", re.IGNORECASE)
+_SIGNOFFS = re.compile(r"^Sent from my .+$", re.IGNORECASE)
+_BLOCK_TAGS = re.compile(r"<\s*(br|/p|/div|/li|/tr|/h\d)\b[^>]*>", re.IGNORECASE)
+_TAGS = re.compile(r"<[^>]+>")
+_HIDDEN = re.compile(r"<(style|script)\b.*?</\1>", re.IGNORECASE | re.DOTALL)
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.encoding_for_model("gpt-4o")
+        except KeyError:
+            _encoding = tiktoken.get_encoding("o200k_base")
+    return _encoding
+
+
+def count_tokens(text):
+    """Token count with tiktoken when installed, else a characters/4 estimate."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens]) + " [truncated]"
+    if len(text) <= max_tokens * CHARS_PER_TOKEN:
+        return text
+    return text[: max_tokens * CHARS_PER_TOKEN] + " [truncated]"
+
+
+def strip_html(text):
+    text = _HIDDEN.sub(" ", text)
+    text = _BLOCK_TAGS.sub("\n", text)
+    return html.unescape(_TAGS.sub(" ", text))
+
+
+def strip_quoted_replies(text):
+    """Drop ">"-quoted lines, mobile sign-offs and everything after the first reply marker."""
+    kept = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if _REPLY_MARKERS.match(stripped):
+            break
+        if not stripped.startswith(">") and not _SIGNOFFS.match(stripped):
+            kept.append(line)
+    return "\n".join(kept)
+
+
+def clean_text(text, seen, strip_quotes=True):
+    """
+    Normalize whitespace, strip HTML and (for notes and emails) quoted
+    replies, and drop lines already in ``seen`` (shared across the whole
+    deal), which removes repeated signatures and re-pasted text.
+    """
+    if not text:
+        return ""
+    if not isinstance(text, str):
+        text = str(text)
+    if "<" in text and ">" in text:
+        text = strip_html(text)
+    if strip_quotes:
+        text = strip_quoted_replies(text)
+    lines = []
+    for line in text.splitlines():
+        line = re.sub(r"\s+", " ", line).strip()
+        key = re.sub(r"\W+", " ", line).strip().lower()
+        if key and key not in seen:
+            seen.add(key)
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def owner_name(details):
+    if not details:
+        return None
+    name = f"{details.get('firstName') or ''} {details.get('lastName') or ''}".strip()
+    return name or None
+
+
+def _note_texts(deal):
+    for note in deal.get("notes") or []:
+        yield (note.get("properties") or {}).get("hs_note_body")
+
+
+def _email_texts(deal):
+    for engagement in deal.get("engagements") or []:
+        metadata = engagement.get("metadata") or {}
+        body = metadata.get("text") or metadata.get("html") or ""
+        subject = metadata.get("subject")
+        yield f"Subject: {subject}\n\n{body}" if subject else body
+
+
+def _attachment_texts(deal):
+    for attachment in deal.get("attachments") or []:
+        yield attachment
+
+
+_SECTION_TEXTS = {
+    "notes": _note_texts,
+    "emails": _email_texts,
+    "attachments": _attachment_texts,
+}
+
+
+def project_deal(deal):
+    """The deal's schema fields, without free text."""
+    properties = deal.get("properties") or {}
+    projected = {
+        name: properties.get(name) for name in PROMPT_PROPERTIES if properties.get(name)
+    }
+    # Owner details are attached at the top level of the deal, not in properties
+    lead_owner = owner_name(deal.get("hubspot_owner_id_details"))
+    support_owner = owner_name(deal.get("team_member_1_details"))
+    if lead_owner:
+        projected["lead_owner"] = lead_owner
+    if support_owner:
+        projected["support_owner"] = support_owner
+    return projected
+
+
+def serialize_deal(
+    deal, budget=DEAL_PROMPT_TOKEN_BUDGET, item_budget=DEAL_PROMPT_ITEM_TOKENS
+):
+    """
+    Compact JSON for one deal, at most about ``budget`` tokens.
+
+    Schema fields always go in. Notes, then emails, then attachments fill
+    the rest, each item capped at ``item_budget`` tokens; items that no
+    longer fit are dropped.
+    """
+    projected = project_deal(deal)
+    remaining = budget - count_tokens(json.dumps(projected, ensure_ascii=False))
+    seen = set()
+    for section in PROMPT_SECTIONS:
+        items = []
+        for text in _SECTION_TEXTS[section](deal):
+            text = clean_text(text, seen, strip_quotes=section != "attachments")
+            if not text:
+                continue
+            # Headroom for JSON quoting and separators
+            allowed = min(item_budget, remaining - 8)
+            if allowed <= 0:
+                break
+            text = truncate_to_tokens(text, allowed)
+            items.append(text)
+            remaining -= count_tokens(text) + 4
+        if items:
+            projected[section] = items
+    return json.dumps(projected, ensure_ascii=False)
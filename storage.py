@@ -0,0 +1,327 @@
+"""Local persistence: synced deals, their enrichments, and TTL caches."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def default_store_dir() -> str:
+    """Directory for local stores; override with ANZU_CACHE_DIR."""
+    path = os.getenv(
+        "ANZU_CACHE_DIR", os.path.join(tempfile.gettempdir(), "anzu-data-exporter")
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _iso_to_ms(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    if str(value).isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+class DealStore:
+    """
+    SQLite-backed store of deals and per-deal enrichments.
+
+    Deals are stored per query key (a hash of the requested property list)
+    so a store filled for one export never serves deals missing properties
+    another export needs. ``sync_windows`` records which createdate ranges
+    are fully synced and the ``hs_lastmodifieddate`` high-water mark each
+    one is current to. Enrichments (stage history, notes, ...) are stored
+    with the ``hs_lastmodifieddate`` of the deal they were fetched for, and
+    are only reused while that value is unchanged.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(default_store_dir(), "deals.sqlite3")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS deals (
+                    query_key TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    createdate_ms INTEGER,
+                    modified TEXT,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (query_key, id)
+                );
+                CREATE INDEX IF NOT EXISTS deals_createdate
+                    ON deals (query_key, createdate_ms);
+                CREATE TABLE IF NOT EXISTS sync_windows (
+                    query_key TEXT NOT NULL,
+                    start_ms INTEGER NOT NULL,
+                    end_ms INTEGER NOT NULL,
+                    high_water_mark INTEGER NOT NULL,
+                    full_synced_at REAL NOT NULL,
+                    PRIMARY KEY (query_key, start_ms, end_ms)
+                );
+                CREATE TABLE IF NOT EXISTS enrichments (
+                    deal_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    modified TEXT,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (deal_id, kind)
+                );
+                """
+            )
+
+    @staticmethod
+    def query_key(properties: Iterable[str]) -> str:
+        return hashlib.sha1(
+            json.dumps(sorted(set(properties))).encode("utf-8")
+        ).hexdigest()
+
+    # ----------------------------------------------------------- sync windows
+
+    def overlapping_window(
+        self, query_key: str, start_ms: int, end_ms: int, max_age: Optional[float] = None
+    ) -> Optional[Tuple[int, int, int]]:
+        """
+        The stored window with the largest overlap with [start_ms, end_ms].
+
+        Windows whose last full sync is older than ``max_age`` seconds are
+        ignored so deletions and pipeline moves are eventually picked up.
+        """
+        min_full_sync = time.time() - max_age if max_age else 0
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT start_ms, end_ms, high_water_mark FROM sync_windows "
+                "WHERE query_key = ? AND start_ms <= ? AND end_ms >= ? "
+                "AND full_synced_at >= ?",
+                (query_key, end_ms, start_ms, min_full_sync),
+            ).fetchall()
+        if not rows:
+            return None
+        return max(
+            rows, key=lambda row: min(row[1], end_ms) - max(row[0], start_ms)
+        )
+
+    def _write_window(
+        self,
+        query_key: str,
+        old_window: Optional[Tuple[int, int]],
+        start_ms: int,
+        end_ms: int,
+        high_water_mark: int,
+        full_synced_at: Optional[float] = None,
+    ) -> None:
+        # Caller holds the lock and the transaction
+        if old_window:
+            row = self._conn.execute(
+                "SELECT full_synced_at FROM sync_windows "
+                "WHERE query_key = ? AND start_ms = ? AND end_ms = ?",
+                (query_key, *old_window),
+            ).fetchone()
+            if full_synced_at is None and row:
+                full_synced_at = row[0]
+            self._conn.execute(
+                "DELETE FROM sync_windows "
+                "WHERE query_key = ? AND start_ms = ? AND end_ms = ?",
+                (query_key, *old_window),
+            )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sync_windows VALUES (?, ?, ?, ?, ?)",
+            (
+                query_key,
+                start_ms,
+                end_ms,
+                high_water_mark,
+                full_synced_at if full_synced_at is not None else time.time(),
+            ),
+        )
+
+    def clear(self, query_key: Optional[str] = None) -> None:
+        """Forget sync windows (and stored deals) so the next sync is a full one."""
+        with self._lock, self._conn:
+            if query_key is None:
+                self._conn.execute("DELETE FROM sync_windows")
+                self._conn.execute("DELETE FROM deals")
+            else:
+                self._conn.execute(
+                    "DELETE FROM sync_windows WHERE query_key = ?", (query_key,)
+                )
+                self._conn.execute("DELETE FROM deals WHERE query_key = ?", (query_key,))
+
+    # ------------------------------------------------------------------ deals
+
+    @staticmethod
+    def _deal_rows(query_key: str, deals: List[dict]) -> list:
+        return [
+            (
+                query_key,
+                str(deal["id"]),
+                _iso_to_ms(deal.get("properties", {}).get("createdate")),
+                deal.get("properties", {}).get("hs_lastmodifieddate"),
+                json.dumps(deal),
+            )
+            for deal in deals
+        ]
+
+    def upsert_deals(self, query_key: str, deals: List[dict]) -> None:
+        rows = self._deal_rows(query_key, deals)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO deals VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def store_sync(
+        self,
+        query_key: str,
+        full: List[Tuple[int, int, List[dict]]],
+        changed: List[dict],
+        old_window: Optional[Tuple[int, int]],
+        start_ms: int,
+        end_ms: int,
+        high_water_mark: int,
+    ) -> None:
+        """
+        Record one sync in a single transaction.
+
+        Each ``(start_ms, end_ms, deals)`` in ``full`` was fetched in full, so
+        it becomes its range's only contents: stored deals it didn't return
+        (deleted, or moved out of the pipeline) are dropped. ``changed`` deals
+        from a modified-since pull are upserted. The window [start_ms, end_ms]
+        replaces ``old_window``.
+        """
+        with self._lock, self._conn:
+            for range_start, range_end, deals in full:
+                self._conn.execute(
+                    "DELETE FROM deals WHERE query_key = ? "
+                    "AND createdate_ms BETWEEN ? AND ?",
+                    (query_key, range_start, range_end),
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO deals VALUES (?, ?, ?, ?, ?)",
+                    self._deal_rows(query_key, deals),
+                )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO deals VALUES (?, ?, ?, ?, ?)",
+                self._deal_rows(query_key, changed),
+            )
+            self._write_window(query_key, old_window, start_ms, end_ms, high_water_mark)
+
+    def deals_in_range(self, query_key: str, start_ms: int, end_ms: int) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM deals WHERE query_key = ? "
+                "AND createdate_ms BETWEEN ? AND ? ORDER BY createdate_ms, id",
+                (query_key, start_ms, end_ms),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    # ------------------------------------------------------------ enrichments
+
+    def get_enrichments(self, deal_ids: List[str], kind: str) -> Dict[str, Tuple[str, dict]]:
+        found = {}
+        ids = [str(deal_id) for deal_id in deal_ids]
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT deal_id, modified, data FROM enrichments "
+                    f"WHERE kind = ? AND deal_id IN ({placeholders})",
+                    (kind, *chunk),
+                ).fetchall()
+            for deal_id, modified, data in rows:
+                found[deal_id] = (modified, json.loads(data))
+        return found
+
+    def put_enrichments(self, kind: str, items: Dict[str, Tuple[str, dict]]) -> None:
+        rows = [
+            (str(deal_id), kind, modified, json.dumps(data, default=str))
+            for deal_id, (modified, data) in items.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO enrichments VALUES (?, ?, ?, ?)", rows
+            )
+
+
+class TTLCache:
+    """
+    Small disk-backed key/value cache with per-entry expiry.
+
+    Values are JSON. Every named cache is a table in one SQLite file, so
+    entries survive cold starts on the same instance. ``meta`` holds
+    per-entry extras such as HTTP validators for conditional revalidation.
+    """
+
+    def __init__(self, name: str, path: Optional[str] = None):
+        self.name = name
+        self.path = path or os.path.join(default_store_dir(), "cache.sqlite3")
+        self._table = f"cache_{hashlib.sha1(name.encode('utf-8')).hexdigest()[:12]}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL, meta TEXT)"
+            )
+
+    def entry(self, key: str) -> Optional[Tuple[object, Optional[float], dict]]:
+        """Return ``(value, expires_at, meta)`` even if expired, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at, meta FROM {self._table} WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], json.loads(row[2]) if row[2] else {}
+
+    def get(self, key: str, default=None):
+        found = self.entry(key)
+        if found is None:
+            return default
+        value, expires_at, _ = found
+        if expires_at is not None and expires_at < time.time():
+            return default
+        return value
+
+    def set(self, key: str, value, ttl: Optional[float] = None, meta: Optional[dict] = None) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self._table} VALUES (?, ?, ?, ?)",
+                (
+                    key,
+                    json.dumps(value, default=str),
+                    expires_at,
+                    json.dumps(meta) if meta else None,
+                ),
+            )
+
+    def touch(self, key: str, ttl: float) -> None:
+        """Extend an entry's expiry without rewriting its value."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE {self._table} SET expires_at = ? WHERE key = ?",
+                (time.time() + ttl, key),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self._table} WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self._table}")
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# main reads its keys and store location at import time
+os.environ.setdefault("OPEN_AI_KEY", "test")
+os.environ.setdefault("HUBSPOT_API_KEY", "test")
+os.environ.setdefault("ANZU_CACHE_DIR", tempfile.mkdtemp(prefix="anzu-tests-"))
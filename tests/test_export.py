@@ -0,0 +1,26 @@
+import csv
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def empty_range(monkeypatch):
+    monkeypatch.setattr(main, "get_stage_mapping", lambda: {"1": "Sourcing"})
+    monkeypatch.setattr(main, "fetch_fund_mapping", lambda: {})
+    monkeypatch.setattr(main, "resolve_owners", lambda owner_ids: {})
+    monkeypatch.setattr(main, "fetch_deals", lambda *args, **kwargs: [])
+    monkeypatch.setattr(main, "fetch_deals_and_stage_histories", lambda *args, **kwargs: [])
+
+
+@pytest.mark.parametrize("stage_source", main.STAGE_SOURCES)
+def test_empty_range_exports_a_header_only_csv(empty_range, stage_source):
+    csv_output, filename = main.export_csv("2024-01-01", "2024-02-01", stage_source)
+
+    rows = list(csv.reader(csv_output))
+    assert filename == "Deal_Export--2024-01-01-2024-02-01.csv"
+    assert len(rows) == 1
+    assert "dealname" in rows[0]
+    assert "Lead Owner Name" in rows[0]
+    assert not set(rows[0]) & set(main.EXPORT_EXCLUDED_COLUMNS)
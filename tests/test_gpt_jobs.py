@@ -0,0 +1,366 @@
+import contextlib
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from gpt_jobs import (
+    FAILED,
+    POLLING,
+    WRITTEN,
+    GptJobFailed,
+    GptJobRunner,
+    job_summary,
+)
+
+
+class FakeCheckpoints:
+    """TTLCache stand-in; values round-trip through JSON like the real one."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, default=None):
+        value = self.values.get(key)
+        return default if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None, meta=None):
+        self.values[key] = json.dumps(value)
+
+
+class FakeFiles:
+    def __init__(self):
+        self.contents = {}
+        self.with_streaming_response = self
+
+    @contextlib.contextmanager
+    def content(self, file_id):
+        yield SimpleNamespace(iter_lines=lambda: iter(self.contents[file_id]))
+
+
+class FakeBatches:
+    """
+    Batches follow a script of statuses, one per retrieve; the last status
+    repeats. Output and error lines are served once a batch completes.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.scripts = {}
+        self.created = []
+
+    def create(self, input_file_id, statuses, output=(), errors=(), error_code=None):
+        batch_id = f"batch_{len(self.created)}"
+        self.created.append((batch_id, input_file_id))
+        self.scripts[batch_id] = {
+            "input_file_id": input_file_id,
+            "statuses": list(statuses),
+            "error_code": error_code,
+        }
+        self.files.contents[f"{batch_id}_out"] = [json.dumps(line) for line in output]
+        self.files.contents[f"{batch_id}_err"] = [json.dumps(line) for line in errors]
+        return SimpleNamespace(id=batch_id, status="validating")
+
+    def retrieve(self, batch_id):
+        script = self.scripts[batch_id]
+        status = script["statuses"].pop(0) if len(script["statuses"]) > 1 else script["statuses"][0]
+        errors = None
+        if status == "failed" and script["error_code"]:
+            errors = SimpleNamespace(data=[SimpleNamespace(code=script["error_code"])])
+        completed = status == "completed"
+        return SimpleNamespace(
+            id=batch_id,
+            status=status,
+            input_file_id=script["input_file_id"],
+            output_file_id=f"{batch_id}_out" if completed else None,
+            error_file_id=f"{batch_id}_err" if completed else None,
+            errors=errors,
+            request_counts=None,
+            in_progress_at=None,
+        )
+
+
+def result_line(deal_id, parsed):
+    return {
+        "custom_id": deal_id,
+        "response": {
+            "status_code": 200,
+            "body": {"choices": [{"message": {"content": json.dumps(parsed)}}]},
+        },
+    }
+
+
+def error_line(deal_id, message):
+    return {"custom_id": deal_id, "response": None, "error": {"message": message}}
+
+
+class Harness:
+    """A runner over fake OpenAI, checkpoint and HubSpot sides with a fake clock."""
+
+    def __init__(self, shards, batch_plans, token_limit=None):
+        self.files = FakeFiles()
+        self.client = SimpleNamespace(batches=FakeBatches(self.files), files=self.files)
+        self.checkpoints = FakeCheckpoints()
+        self.shards = shards
+        # Per input file: the create() kwargs of each successive batch made from it
+        self.batch_plans = {key: list(plans) for key, plans in batch_plans.items()}
+        self.token_limit = token_limit
+        self.now = 0.0
+        self.written = []
+        # Deal IDs write() reports as skipped (no recommendation, unchanged)
+        self.skip = set()
+
+    def upload(self, deals):
+        return [dict(shard) for shard in self.shards]
+
+    def create_batch(self, input_file_id):
+        return self.client.batches.create(input_file_id, **self.batch_plans[input_file_id].pop(0))
+
+    def write(self, deals):
+        written = [deal["id"] for deal in deals if deal["id"] not in self.skip]
+        self.written.extend(written)
+        return {deal_id: None for deal_id in written}, [
+            deal["id"] for deal in deals if deal["id"] in self.skip
+        ]
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def runner(self):
+        return GptJobRunner(
+            self.client,
+            self.checkpoints,
+            upload=self.upload,
+            create_batch=self.create_batch,
+            write=self.write,
+            token_limit=self.token_limit,
+            clock=lambda: self.now,
+            sleep=self.sleep,
+            wall_clock=lambda: 1_000_000 + self.now,
+        )
+
+
+def deals(*ids):
+    return [{"id": deal_id, "properties": {"dealname": f"Deal {deal_id}"}} for deal_id in ids]
+
+
+def test_resumes_from_checkpoint_after_budget_runs_out():
+    harness = Harness(
+        shards=[{"input_file_id": "file_a", "tokens": 10}],
+        batch_plans={
+            "file_a": [
+                {
+                    "statuses": ["in_progress"] * 6 + ["completed"],
+                    "output": [result_line("1", {"recommendation": ["x"]})],
+                }
+            ]
+        },
+    )
+    job = harness.runner().start(deals("1"))
+
+    job = harness.runner().run(job["id"], budget=5)
+    assert job["state"] == POLLING
+    assert harness.written == []
+
+    # A fresh runner (a later invocation) picks up the same batch
+    job = harness.runner().run(job["id"], budget=600)
+    assert job["state"] == WRITTEN
+    assert job["parsed"] == {"1": {"recommendation": ["x"]}}
+    assert harness.written == ["1"]
+    assert len(harness.client.batches.created) == 1
+
+
+def test_queued_shards_wait_for_enqueued_tokens_to_drain():
+    harness = Harness(
+        shards=[
+            {"input_file_id": "file_a", "tokens": 60},
+            {"input_file_id": "file_b", "tokens": 60},
+        ],
+        batch_plans={
+            "file_a": [
+                {
+                    "statuses": ["in_progress", "completed"],
+                    "output": [result_line("1", {"recommendation": ["a"]})],
+                }
+            ],
+            "file_b": [
+                {
+                    "statuses": ["completed"],
+                    "output": [result_line("2", {"recommendation": ["b"]})],
+                }
+            ],
+        },
+        token_limit=100,
+    )
+    runner = harness.runner()
+    job = runner.start(deals("1", "2"))
+    assert [input_file for _, input_file in harness.client.batches.created] == ["file_a"]
+    assert job_summary(job)["queued"] == 1
+
+    runner.poll(job)
+    assert len(harness.client.batches.created) == 1
+
+    job = runner.run(job["id"])
+    assert [input_file for _, input_file in harness.client.batches.created] == [
+        "file_a",
+        "file_b",
+    ]
+    assert job["state"] == WRITTEN
+    assert sorted(harness.written) == ["1", "2"]
+
+
+def test_token_limit_failure_is_resubmitted_once_capacity_frees():
+    harness = Harness(
+        shards=[
+            {"input_file_id": "file_a", "tokens": 50},
+            {"input_file_id": "file_b", "tokens": 40},
+        ],
+        batch_plans={
+            "file_a": [
+                {"statuses": ["failed"], "error_code": "token_limit_exceeded"},
+                {
+                    "statuses": ["completed"],
+                    "output": [result_line("1", {"recommendation": ["a"]})],
+                },
+            ],
+            "file_b": [
+                {
+                    "statuses": ["in_progress", "in_progress", "completed"],
+                    "output": [result_line("2", {"recommendation": ["b"]})],
+                }
+            ],
+        },
+        token_limit=100,
+    )
+    runner = harness.runner()
+    job = runner.start(deals("1", "2"))
+    assert len(harness.client.batches.created) == 2
+
+    # file_a hits the limit while file_b is still enqueued: it must wait
+    runner.poll(job)
+    assert len(harness.client.batches.created) == 2
+    assert job["queued"][0]["input_file_id"] == "file_a"
+    runner.poll(job)
+    assert len(harness.client.batches.created) == 2
+
+    job = runner.run(job["id"])
+    assert [input_file for _, input_file in harness.client.batches.created] == [
+        "file_a",
+        "file_b",
+        "file_a",
+    ]
+    assert job["state"] == WRITTEN
+    assert sorted(harness.written) == ["1", "2"]
+
+
+def test_repeated_token_limit_failures_fail_the_job():
+    harness = Harness(
+        shards=[{"input_file_id": "file_a", "tokens": 50}],
+        batch_plans={
+            "file_a": [{"statuses": ["failed"], "error_code": "token_limit_exceeded"}] * 10
+        },
+        token_limit=100,
+    )
+    runner = harness.runner()
+    job = runner.start(deals("1"))
+    with pytest.raises(GptJobFailed):
+        runner.run(job["id"], budget=10_000)
+    assert harness.checkpoints.get(job["id"])["state"] == FAILED
+
+
+def test_error_file_lines_are_recorded_per_deal():
+    harness = Harness(
+        shards=[{"input_file_id": "file_a", "tokens": 10}],
+        batch_plans={
+            "file_a": [
+                {
+                    "statuses": ["completed"],
+                    "output": [result_line("1", {"recommendation": ["a"]})],
+                    "errors": [error_line("2", "context_length_exceeded")],
+                }
+            ]
+        },
+    )
+    runner = harness.runner()
+    job = runner.start(deals("1", "2"))
+    runner.poll(job)
+    assert job["errors"] == {"2": "context_length_exceeded"}
+    assert set(job["parsed"]) == {"1"}
+    assert job_summary(job)["failed"] == {"2": "context_length_exceeded"}
+
+
+def test_each_batch_is_written_as_soon_as_it_is_downloaded():
+    harness = Harness(
+        shards=[
+            {"input_file_id": "file_a", "tokens": 10},
+            {"input_file_id": "file_b", "tokens": 10},
+        ],
+        batch_plans={
+            "file_a": [
+                {
+                    "statuses": ["completed"],
+                    "output": [result_line("1", {"recommendation": ["a"]})],
+                }
+            ],
+            "file_b": [
+                {
+                    "statuses": ["in_progress"] * 5 + ["completed"],
+                    "output": [result_line("2", {"recommendation": ["b"]})],
+                }
+            ],
+        },
+    )
+    runner = harness.runner()
+    job = runner.run(runner.start(deals("1", "2"))["id"], budget=5)
+    assert job["state"] == POLLING
+    assert harness.written == ["1"]
+    assert "results" not in harness.checkpoints.get(job["id"])
+
+    job = runner.run(job["id"], budget=600)
+    assert job["state"] == WRITTEN
+    assert harness.written == ["1", "2"]
+
+
+def test_skipped_deals_are_not_counted_as_written():
+    harness = Harness(
+        shards=[{"input_file_id": "file_a", "tokens": 10}],
+        batch_plans={
+            "file_a": [
+                {
+                    "statuses": ["completed"],
+                    "output": [
+                        result_line("1", {"recommendation": ["a"]}),
+                        result_line("2", {"recommendation": []}),
+                    ],
+                }
+            ]
+        },
+    )
+    harness.skip = {"2"}
+    runner = harness.runner()
+    job = runner.run(runner.start(deals("1", "2"))["id"])
+    summary = job_summary(job)
+    assert (summary["written"], summary["skipped"]) == (1, 1)
+    assert summary["write_errors"] == {}
+
+
+def test_unknown_custom_id_is_reported_as_an_error():
+    harness = Harness(
+        shards=[{"input_file_id": "file_a", "tokens": 10}],
+        batch_plans={
+            "file_a": [
+                {
+                    "statuses": ["completed"],
+                    "output": [
+                        result_line("1", {"recommendation": ["a"]}),
+                        result_line("request-7", {"dealname": "Deal 1", "recommendation": []}),
+                    ],
+                }
+            ]
+        },
+    )
+    runner = harness.runner()
+    job = runner.run(runner.start(deals("1"))["id"])
+    assert job["parsed"] == {"1": {"recommendation": ["a"]}}
+    assert job_summary(job)["failed"] == {"request-7": "Unknown custom_id"}
+    assert harness.written == ["1"]
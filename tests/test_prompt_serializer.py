@@ -0,0 +1,66 @@
+import json
+
+from prompt_serializer import serialize_deal, strip_quoted_replies
+
+
+def test_forwarded_email_keeps_the_forwarded_message():
+    text = "\n".join(
+        [
+            "FYI, see the deck they sent over.",
+            "",
+            "Sent from my iPhone",
+            "",
+            "---------- Forwarded message ---------",
+            "From: Jane Founder <jane@example.com>",
+            "Date: Mon, 3 Jun 2024 at 09:12",
+            "Subject: Seed round",
+            "To: Partner <partner@example.com>",
+            "",
+            "We are raising a $2M seed to expand into Germany.",
+        ]
+    )
+    stripped = strip_quoted_replies(text)
+
+    assert "FYI, see the deck they sent over." in stripped
+    assert "From: Jane Founder <jane@example.com>" in stripped
+    assert "We are raising a $2M seed to expand into Germany." in stripped
+    assert "Sent from my iPhone" not in stripped
+
+
+def test_reply_chain_is_cut_at_the_reply_history():
+    text = "\n".join(
+        [
+            "Thanks, we'll pass for now.",
+            "> inline quote of their question",
+            "",
+            "On Mon, Jun 3, 2024 at 9:12 AM Jane Founder <jane@example.com> wrote:",
+            "Would you like to join the round?",
+            "",
+            "-----Original Message-----",
+            "Earlier thread",
+        ]
+    )
+    assert strip_quoted_replies(text) == "Thanks, we'll pass for now.\n"
+
+
+def test_outlook_original_message_marker_cuts_the_rest():
+    text = "Sounds good.\n----- Original Message -----\nFrom: someone\nOld text"
+    assert strip_quoted_replies(text) == "Sounds good."
+
+
+def test_serialized_deal_keeps_forwarded_email_content():
+    deal = {
+        "properties": {"dealname": "Acme"},
+        "engagements": [
+            {
+                "metadata": {
+                    "subject": "Fwd: Seed round",
+                    "text": "---------- Forwarded message ---------\n"
+                    "From: Jane Founder <jane@example.com>\n\n"
+                    "We are raising a $2M seed.",
+                }
+            }
+        ],
+    }
+    emails = json.loads(serialize_deal(deal))["emails"]
+    assert "We are raising a $2M seed." in emails[0]
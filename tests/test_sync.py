@@ -0,0 +1,64 @@
+import pytest
+
+import main
+from storage import DealStore
+
+PROPERTIES = ["dealname", "createdate", "hs_lastmodifieddate"]
+
+
+class FakeHubSpot:
+    """Deals by ID as (createdate_ms, modified_ms); serves fetch_deal_windows."""
+
+    def __init__(self, deals):
+        self.deals = dict(deals)
+        self.calls = []
+
+    async def fetch_deal_windows(self, start_ms, end_ms, properties, modified_since=None):
+        self.calls.append((start_ms, end_ms, modified_since))
+        return [
+            {
+                "id": deal_id,
+                "properties": {
+                    "createdate": str(created),
+                    "hs_lastmodifieddate": str(modified),
+                },
+            }
+            for deal_id, (created, modified) in sorted(self.deals.items())
+            if start_ms <= created <= end_ms
+            and (modified_since is None or modified >= modified_since)
+        ]
+
+
+@pytest.fixture
+def fake_hubspot(tmp_path, monkeypatch):
+    fake = FakeHubSpot({"a": (10, 1), "b": (60, 1)})
+    monkeypatch.setattr(main, "deal_store", DealStore(str(tmp_path / "deals.sqlite3")))
+    monkeypatch.setattr(main, "fetch_deal_windows", fake.fetch_deal_windows)
+    return fake
+
+
+def age_windows(store):
+    with store._conn:
+        store._conn.execute("UPDATE sync_windows SET full_synced_at = 0")
+
+
+def stored_ids(start_ms, end_ms):
+    return [deal["id"] for deal in main.sync_deals(start_ms, end_ms, PROPERTIES)]
+
+
+def test_full_resync_drops_deleted_deals(fake_hubspot):
+    assert stored_ids(0, 100) == ["a", "b"]
+    age_windows(main.deal_store)
+    del fake_hubspot.deals["a"]
+    assert stored_ids(0, 100) == ["b"]
+
+
+def test_range_outside_stored_window_drops_deleted_deals(fake_hubspot):
+    assert stored_ids(0, 100) == ["a", "b"]
+    age_windows(main.deal_store)
+    assert stored_ids(50, 100) == ["b"]
+
+    # [0, 49] is outside the fresh window, so it is fetched in full again
+    del fake_hubspot.deals["a"]
+    assert stored_ids(0, 100) == ["b"]
+    assert (0, 49, None) in fake_hubspot.calls